@@ -229,6 +229,37 @@ def remove_after_slash(value):
         return value_str.split('/')[0].strip()
     return value_str
 
+def remove_after_slash_column(values):
+    """整列版 remove_after_slash：结果与逐行调用完全一致"""
+    missing = values.isna().to_numpy()
+    value_str = values.astype(str).astype(object).str.strip()
+    cleaned = value_str.str.split('/', n=1, regex=False).str[0].str.strip()
+    return cleaned.mask(missing, '')
+
+def get_column(df, col, default=''):
+    """按列名取列，缺失时返回填充默认值的列（等价于逐行 row.get(col, default)）"""
+    if col in df.columns:
+        return df[col]
+    return pd.Series(default, index=df.index, dtype=object)
+
+def build_lead_columns(names, phones, source_category, source_detail, car_series):
+    """按输出列顺序整列组装线索数据，常量列直接填充"""
+    n = len(names)
+    blank = np.full(n, '', dtype=object)
+    return {
+        '姓名': names.to_numpy(dtype=object),
+        '手机号': phones.to_numpy(dtype=object),
+        '性别': blank,
+        '来源分类': source_category.to_numpy(dtype=object),
+        '线索来源': source_detail.to_numpy(dtype=object),
+        '备注': blank,
+        '意向品牌': np.full(n, '别克', dtype=object),
+        '意向车系': car_series.to_numpy(dtype=object),
+        '销售顾问': blank,
+        '单位': blank,
+        '跟进内容': blank
+    }
+
 def get_consultant_unit(consultant_name):
     """获取顾问所属单位"""
     if consultant_name in ["张理平", "邵振艺", "耿佶", "陈婷"]:
@@ -270,16 +301,13 @@ def map_source(source_value, mapping_dict, field_name="来源"):
     
     return ""
 
-def fair_allocate_consultants(records, selected_consultants_dict, first_consultant=None):
+def fair_allocate_consultants(df, selected_consultants_dict, first_consultant=None):
     """公平分配销售顾问"""
     # 获取选中的顾问列表
     available_consultants = [name for name, selected in selected_consultants_dict.items() if selected]
     
     if not available_consultants:
-        return records
-    
-    # 初始化计数器
-    consultant_counts = {consultant: 0 for consultant in available_consultants}
+        return df
     
     # 如果指定了第一条线索的顾问，调整队列
     if first_consultant and first_consultant in available_consultants:
@@ -288,114 +316,75 @@ def fair_allocate_consultants(records, selected_consultants_dict, first_consulta
     else:
         consultant_queue = available_consultants.copy()
     
-    # 为每条记录分配顾问
-    for i, record in enumerate(records):
-        # 选择分配最少的顾问
-        available_counts = {c: consultant_counts[c] for c in consultant_queue}
-        min_count = min(available_counts.values())
-        min_consultants = [c for c, count in available_counts.items() if count == min_count]
-        
-        # 选择在队列中位置靠前的
-        selected_consultant = consultant_queue[0]  # 默认选择第一个
-        for consultant in consultant_queue:
-            if consultant in min_consultants:
-                selected_consultant = consultant
-                break
-        
-        # 更新分配数量
-        consultant_counts[selected_consultant] += 1
-        
-        # 分配顾问和单位
-        record['销售顾问'] = selected_consultant
-        record['单位'] = get_consultant_unit(selected_consultant)
+    # 每次选分配最少、队列中靠前的顾问，等价于按队列顺序轮询
+    positions = np.arange(len(df)) % len(consultant_queue)
+    queue = np.array(consultant_queue, dtype=object)
+    units = np.array([get_consultant_unit(consultant) for consultant in consultant_queue], dtype=object)
+    
+    # 分配顾问和单位
+    df['销售顾问'] = queue[positions]
+    df['单位'] = units[positions]
     
-    return records
+    return df
 
 def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consultant):
     """处理合并逻辑"""
-    results = []
+    parts = []
     
     # 处理易车网数据
     if df_yiche is not None:
         st.info(f"处理易车网数据: {len(df_yiche)} 条记录")
-        for idx, row in df_yiche.iterrows():
-            name = remove_after_slash(row.get('客户姓名', ''))
-            phone = remove_after_slash(row.get('客户号码', ''))
-            
-            if pd.isna(name) or pd.isna(phone) or name == '' or phone == '':
-                continue
-            
-            # 标准化车系
-            original_car_series = row.get('线索意向车型车系', '')
-            car_series = normalize_car_series(original_car_series, default_value="昂科威PLUS", original_source="易车网")
-            
-            # 来源信息
-            source = row.get('商业产品来源', '')
-            if pd.isna(source):
-                source = row.get('来源', '')
-            
-            source_category = map_source(source, source_category_mapping, "来源分类")
-            source_detail = map_source(source, source_detail_mapping, "线索来源")
-            
-            results.append({
-                '姓名': name,
-                '手机号': phone,
-                '性别': '',
-                '来源分类': source_category,
-                '线索来源': source_detail,
-                '备注': '',
-                '意向品牌': '别克',
-                '意向车系': car_series,
-                '销售顾问': '',
-                '单位': '',
-                '跟进内容': '',
-                # 注释掉原始车系和原始来源字段
-                # '原始车系': str(original_car_series),
-                # '原始来源': str(source)
-            })
+        names = remove_after_slash_column(get_column(df_yiche, '客户姓名'))
+        phones = remove_after_slash_column(get_column(df_yiche, '客户号码'))
+        valid = ((names != '') & (phones != '')).to_numpy()
+        df_valid = df_yiche[valid]
+        
+        # 标准化车系
+        original_car_series = get_column(df_valid, '线索意向车型车系').astype(object)
+        car_series = original_car_series.map(
+            lambda value: normalize_car_series(value, default_value="昂科威PLUS", original_source="易车网")
+        )
+        
+        # 来源信息
+        source = get_column(df_valid, '商业产品来源').astype(object)
+        source = source.mask(source.isna().to_numpy(), get_column(df_valid, '来源').astype(object))
+        
+        source_category = source.map(lambda value: map_source(value, source_category_mapping, "来源分类"))
+        source_detail = source.map(lambda value: map_source(value, source_detail_mapping, "线索来源"))
+        
+        parts.append(build_lead_columns(names[valid], phones[valid], source_category, source_detail, car_series))
     
     # 处理汽车之家数据
     if df_autohome is not None:
         st.info(f"处理汽车之家数据: {len(df_autohome)} 条记录")
-        for idx, row in df_autohome.iterrows():
-            name = remove_after_slash(row.get('客户姓名', ''))
-            phone = remove_after_slash(row.get('客户手机', ''))
-            
-            if pd.isna(name) or pd.isna(phone) or name == '' or phone == '':
-                continue
-            
-            # 标准化车系
-            original_car_series = row.get('意向车系', '')
-            car_series = normalize_car_series(original_car_series, default_value="昂科威PLUS", original_source="汽车之家")
-            
-            # 来源信息
-            bmd_source = row.get('BMD二级渠道', '')
-            source_category = map_source(bmd_source, source_category_mapping, "来源分类")
-            source_detail = map_source(bmd_source, source_detail_mapping, "线索来源")
-            
-            results.append({
-                '姓名': name,
-                '手机号': phone,
-                '性别': '',
-                '来源分类': source_category,
-                '线索来源': source_detail,
-                '备注': '',
-                '意向品牌': '别克',
-                '意向车系': car_series,
-                '销售顾问': '',
-                '单位': '',
-                '跟进内容': '',
-                # 注释掉原始车系和原始来源字段
-                # '原始车系': str(original_car_series),
-                # '原始来源': str(bmd_source)
-            })
+        names = remove_after_slash_column(get_column(df_autohome, '客户姓名'))
+        phones = remove_after_slash_column(get_column(df_autohome, '客户手机'))
+        valid = ((names != '') & (phones != '')).to_numpy()
+        df_valid = df_autohome[valid]
+        
+        # 标准化车系
+        original_car_series = get_column(df_valid, '意向车系').astype(object)
+        car_series = original_car_series.map(
+            lambda value: normalize_car_series(value, default_value="昂科威PLUS", original_source="汽车之家")
+        )
+        
+        # 来源信息
+        bmd_source = get_column(df_valid, 'BMD二级渠道').astype(object)
+        source_category = bmd_source.map(lambda value: map_source(value, source_category_mapping, "来源分类"))
+        source_detail = bmd_source.map(lambda value: map_source(value, source_detail_mapping, "线索来源"))
+        
+        parts.append(build_lead_columns(names[valid], phones[valid], source_category, source_detail, car_series))
     
     # 合并结果
-    if not results:
+    total = sum(len(part['姓名']) for part in parts)
+    if total == 0:
         st.error("没有找到有效数据")
         return None
     
-    df = pd.DataFrame(results)
+    df = pd.DataFrame({
+        col: np.concatenate([part[col] for part in parts])
+        for col in parts[0]
+    })
     
     # 去重
     before_dedup = len(df)
@@ -410,11 +399,8 @@ def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consul
         df['意向车系'] = df['意向车系'].apply(lambda x: "昂科威PLUS" if pd.isna(x) or str(x).strip() == '' else x)
     
     # 公平分配销售顾问
-    records = df.to_dict('records')
-    records = fair_allocate_consultants(records, selected_consultants_dict, first_consultant)
-    
-    # 转换回DataFrame
-    df = pd.DataFrame(records)
+    df = df.reset_index(drop=True)
+    df = fair_allocate_consultants(df, selected_consultants_dict, first_consultant)
     
     # 确保数据列的顺序（去除不需要的列）
     final_columns = [
@@ -5,10 +5,28 @@ import random
 import re
 import io
 import json
+import copy
+import hashlib
+import codecs
+import time
+import importlib.machinery
+import importlib.util
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import tempfile
+import tracemalloc
+import zipfile
 import os
+import math
+import multiprocessing
+import itertools
+import difflib
+import bisect
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from openpyxl import Workbook
+from csv_repair import iter_repaired_csv, repair_csv_chunk
 
 # 设置页面配置
 st.set_page_config(
@@ -29,6 +47,52 @@ if 'processing_log' not in st.session_state:
     st.session_state.processing_log = []
 if 'fixed_yiche_df' not in st.session_state:
     st.session_state.fixed_yiche_df = None   # 修复后的易车网数据
+if 'upload_cache' not in st.session_state:
+    st.session_state.upload_cache = OrderedDict()   # (内容哈希, 解析选项) -> (DataFrame, 占用字节)
+if 'upload_hashes' not in st.session_state:
+    st.session_state.upload_hashes = {}   # 上传文件ID -> 内容哈希
+if 'upload_cache_max_mb' not in st.session_state:
+    st.session_state.upload_cache_max_mb = 512
+if 'excel_engine' not in st.session_state:
+    st.session_state.excel_engine = "自动"   # 汽车之家Excel读取引擎
+if 'yiche_streaming' not in st.session_state:
+    st.session_state.yiche_streaming = False   # 易车网CSV分块流式处理
+if 'yiche_chunk_rows' not in st.session_state:
+    st.session_state.yiche_chunk_rows = 100000
+if 'repair_workers' not in st.session_state:
+    st.session_state.repair_workers = min(os.cpu_count() or 1, 8)   # CSV修复并行进程数，1 为串行
+if 'use_allocation_ledger' not in st.session_state:
+    st.session_state.use_allocation_ledger = True   # 按累计分配台账平衡每次的余数
+if 'skip_exported_phones' not in st.session_state:
+    st.session_state.skip_exported_phones = True   # 排除历史已导出的手机号
+if 'bloom_fpr' not in st.session_state:
+    st.session_state.bloom_fpr = 0.01   # 历史号码布隆过滤器的设定误判率
+if 'incremental_merge' not in st.session_state:
+    st.session_state.incremental_merge = False   # 增量合并：按水位跳过已处理的行
+if 'pending_watermarks' not in st.session_state:
+    st.session_state.pending_watermarks = {}   # 本次合并得到的新水位，记入台账时保存
+if 'allocation_seed' not in st.session_state:
+    st.session_state.allocation_seed = 0   # 余数随机分配的种子，0 表示使用本会话的随机种子
+if 'session_allocation_seed' not in st.session_state:
+    st.session_state.session_allocation_seed = random.randrange(1, 2 ** 31)   # 每个会话抽取一次
+if 'merge_memo' not in st.session_state:
+    st.session_state.merge_memo = OrderedDict()   # 合并输入与配置的哈希 -> (合并结果, 新水位)
+if 'merge_state' not in st.session_state:
+    st.session_state.merge_state = None   # 上次合并的中间结果（原值编码与映射表），规则修改后据此增量重映射
+if 'merge_result_stale' not in st.session_state:
+    st.session_state.merge_result_stale = False   # 排除规则变化后合并结果需要重新生成
+if 'fixed_yiche_hash' not in st.session_state:
+    st.session_state.fixed_yiche_hash = None   # 修复后数据对应的上传文件哈希
+if 'export_cache' not in st.session_state:
+    st.session_state.export_cache = {}   # (合并结果指纹, 导出格式) -> 导出文件字节，只保留当前结果的
+if 'allocation_run' not in st.session_state:
+    st.session_state.allocation_run = None   # (合并结果, {'key': 台账 run_key, 'recorded': 是否已记入})
+if 'rule_profile' not in st.session_state:
+    st.session_state.rule_profile = None   # (合并状态, (规则类型, 规则列表哈希), 规则命中统计表)
+if 'trace_export_memory' not in st.session_state:
+    st.session_state.trace_export_memory = False   # 生成导出文件时用 tracemalloc 统计峰值内存
+if 'merged_fingerprint' not in st.session_state:
+    st.session_state.merged_fingerprint = None   # (合并结果, 指纹)，结果对象不变时不重复计算
 
 # 初始化销售人员名单
 if 'consultant_settings' not in st.session_state:
@@ -121,9 +185,434 @@ if 'source_detail_mapping' not in st.session_state:
         {"原始来源": "别克", "目标线索来源": "", "是否启用": True},
     ]
 
+PROCESSING_LOG_MAX_ENTRIES = 1000   # 会话中最多保留的日志条数
+PROCESSING_LOG_DISPLAY_ENTRIES = 50   # 处理页显示最近的日志条数
+
 def add_log(message):
-    """添加处理日志"""
-    st.session_state.processing_log.append(f"{datetime.now().strftime('%H:%M:%S')} - {message}")
+    """添加处理日志（只保留最近 PROCESSING_LOG_MAX_ENTRIES 条）"""
+    log = st.session_state.processing_log
+    log.append(f"{datetime.now().strftime('%H:%M:%S')} - {message}")
+    del log[:-PROCESSING_LOG_MAX_ENTRIES]
+
+# 编码检测：只检查有限长度的前缀（从第一个非 ASCII 字节开始），一次确定编码，所有读取入口共用
+ENCODING_SNIFF_BYTES = 64 * 1024
+NON_ASCII_BYTE = re.compile(rb'[\x80-\xff]')
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+def can_decode(window, encoding, final):
+    """检查字节片段能否按指定编码解码（片段末尾可能截断多字节字符）"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(window, final=final)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def detect_encoding(data, label="CSV", sniff_bytes=ENCODING_SNIFF_BYTES):
+    """根据 BOM 与前缀字节判断文件编码，并把结果和耗时写入处理日志"""
+    start_time = time.perf_counter()
+    encoding = None
+    for bom, bom_encoding in BOM_ENCODINGS:
+        if data.startswith(bom):
+            encoding = bom_encoding
+            break
+    if encoding is None:
+        first = NON_ASCII_BYTE.search(data)
+        if first is None:
+            encoding = 'utf-8'   # 纯 ASCII
+        else:
+            window = data[first.start():first.start() + sniff_bytes]
+            final = first.start() + sniff_bytes >= len(data)
+            for candidate in ['utf-8', 'gbk', 'gb18030']:
+                if can_decode(window, candidate, final):
+                    encoding = candidate
+                    break
+            else:
+                encoding = 'utf-8'   # 无法识别时按原逻辑忽略错误字节解码
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    add_log(f"{label} 编码检测: {encoding}（{elapsed_ms:.1f} ms）")
+    return encoding
+
+def decode_content(data, encoding):
+    """按检测出的编码解码，失败时退回 utf-8 并忽略错误字节"""
+    try:
+        return data.decode(encoding)
+    except UnicodeDecodeError:
+        add_log(f"按 {encoding} 解码失败，改为 utf-8 忽略错误字节")
+        return data.decode('utf-8', errors='ignore')
+
+# 车系规则编译：启用的规则只编译一次，合并为按顺序匹配的正则
+# 含反向引用/命名组/内联标志的模式无法安全拼接，单独编译；无效正则按原逻辑退化为字符串包含匹配
+UNCOMBINABLE_PATTERN = re.compile(r'\\[1-9]|\\g<|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]')
+
+def mapping_rules_key(rules, pattern_field, target_field):
+    """计算启用的映射规则的哈希，用于判断编译结果/索引是否需要重建"""
+    enabled = [(rule[pattern_field], rule[target_field]) for rule in rules if rule["是否启用"]]
+    payload = json.dumps(enabled, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def validate_car_series_rules(rules):
+    """校验车系规则中的正则表达式，返回错误信息列表"""
+    errors = []
+    for i, rule in enumerate(rules, 1):
+        pattern = rule.get("原始模式")
+        if not isinstance(pattern, str) or pattern == '':
+            errors.append(f"第 {i} 条规则缺少原始模式")
+            continue
+        try:
+            re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            errors.append(f"第 {i} 条规则 '{pattern}' 不是有效的正则表达式: {e}")
+    return errors
+
+def compile_car_series_rules(rules):
+    """将启用的车系规则编译为按顺序排列的匹配段，保持先匹配先生效"""
+    segments = []
+    pending = []  # 当前可拼接的 (模式, 目标车系)
+
+    def flush():
+        if not pending:
+            return
+        # 每个分支在开头做前瞻，等价于对整个字符串 re.search；分支按规则顺序尝试
+        alternatives = [
+            f"(?=[\\s\\S]*?(?:{pattern}))(?P<r{i}>)" for i, (pattern, _) in enumerate(pending)
+        ]
+        try:
+            combined = re.compile(r"\A(?:" + "|".join(alternatives) + ")", re.IGNORECASE)
+            segments.append(('combined', combined, [target for _, target in pending]))
+        except re.error:
+            for pattern, target in pending:
+                segments.append(('single', re.compile(pattern, re.IGNORECASE), target))
+        pending.clear()
+
+    for rule in rules:
+        if not rule["是否启用"]:
+            continue
+        pattern = rule["原始模式"]
+        target = rule["目标车系"]
+        if not isinstance(pattern, str):
+            continue
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            flush()
+            segments.append(('literal', pattern, target))
+            continue
+        if UNCOMBINABLE_PATTERN.search(pattern):
+            flush()
+            segments.append(('single', compiled, target))
+        else:
+            pending.append((pattern, target))
+    flush()
+    return segments
+
+def get_car_series_matcher():
+    """获取编译后的车系规则（按启用规则的哈希缓存在 session state 中）"""
+    key = mapping_rules_key(st.session_state.car_series_mapping, "原始模式", "目标车系")
+    cached = st.session_state.get('car_series_matcher')
+    if cached is None or cached['key'] != key:
+        cached = {'key': key, 'segments': compile_car_series_rules(st.session_state.car_series_mapping)}
+        st.session_state.car_series_matcher = cached
+    return cached['segments']
+
+def match_car_series(segments, original):
+    """按规则顺序匹配车系，返回 (是否命中, 目标车系)"""
+    for kind, matcher, target in segments:
+        if kind == 'combined':
+            m = matcher.match(original)
+            if m:
+                return True, target[int(m.lastgroup[1:])]
+        elif kind == 'single':
+            if matcher.search(original):
+                return True, target
+        elif matcher in original or original in matcher:
+            return True, target
+    return False, None
+
+# 来源规则索引：规则命中条件为“规则文本包含于来源”或“来源包含于规则文本”，取启用规则中序号最小者
+# - 规则文本的全部子串 -> 最小规则序号（来源包含于规则，精确匹配也落在这里）
+# - Aho-Corasick 自动机（规则包含于来源）
+SOURCE_TEXT_SEPARATOR = '\x00'   # 拼接规则文本的分隔符，来源值中不会出现
+SOURCE_AUTOMATON_MIN_SCANS = 2000000   # 逐条判断累计超过该次数后才建 Aho-Corasick 自动机
+
+def build_source_index(rules, target_field):
+    """为来源映射规则建立双向包含索引（大小与规则总长度成正比）
+
+    规则文本包含来源值：按顺序拼接成一个长串，str.find 找到的第一个位置即属于序号最小的规则；
+    来源值包含规则文本：先逐条判断，查找量足够大时再建 Aho-Corasick 自动机，只扫描一遍来源值。
+    """
+    texts = []
+    targets = []
+    for rule in rules:
+        if rule["是否启用"] and isinstance(rule["原始来源"], str):
+            texts.append(rule["原始来源"])
+            targets.append(rule[target_field])
+
+    # 规则文本按顺序拼接，starts 为各规则在长串中的起点，供二分查找命中位置所属的规则
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + len(SOURCE_TEXT_SEPARATOR)
+    joined = SOURCE_TEXT_SEPARATOR.join(texts)
+
+    return {'joined': joined, 'starts': starts, 'texts': texts, 'targets': targets, 'miss': len(texts),
+            'automaton': None, 'scans': 0}
+
+def build_source_automaton(texts):
+    """Aho-Corasick：goto 表 + 失败指针，best[node] 为该状态（含失败链）可命中的最小规则序号"""
+    miss = len(texts)
+    goto = [{}]
+    best = [miss]
+    for i, text in enumerate(texts):
+        node = 0
+        for char in text:
+            nxt = goto[node].get(char)
+            if nxt is None:
+                nxt = len(goto)
+                goto[node][char] = nxt
+                goto.append({})
+                best.append(miss)
+            node = nxt
+        best[node] = min(best[node], i)
+    fail = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for char, child in goto[node].items():
+            f = fail[node]
+            while f and char not in goto[f]:
+                f = fail[f]
+            fail[child] = goto[f].get(char, 0) if node else 0
+            best[child] = min(best[child], best[fail[child]])
+            queue.append(child)
+    return {'goto': goto, 'fail': fail, 'best': best}
+
+def lookup_source_index(index, source_str):
+    """在来源索引中查找命中的第一条规则，返回 (是否命中, 目标值)"""
+    texts = index['texts']
+    if SOURCE_TEXT_SEPARATOR in source_str:
+        # 含分隔符的值可能跨规则匹配，逐条判断
+        hit = next((i for i, text in enumerate(texts) if source_str in text), index['miss'])
+    else:
+        position = index['joined'].find(source_str)
+        hit = bisect.bisect_right(index['starts'], position) - 1 if position != -1 else index['miss']
+    
+    # 来源值包含规则文本：只需检查序号小于当前命中的规则
+    if index['automaton'] is None and index['scans'] >= SOURCE_AUTOMATON_MIN_SCANS:
+        index['automaton'] = build_source_automaton(texts)
+    if index['automaton'] is None:
+        index['scans'] += hit
+        hit = next((i for i in range(hit) if texts[i] in source_str), hit)
+    else:
+        goto = index['automaton']['goto']
+        fail = index['automaton']['fail']
+        best = index['automaton']['best']
+        hit = min(hit, best[0])
+        node = 0
+        for char in source_str:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if best[node] < hit:
+                hit = best[node]
+    if hit == index['miss']:
+        return False, None
+    return True, index['targets'][hit]
+
+def get_source_index(mapping_name, target_field):
+    """获取来源映射规则的索引（按启用规则的哈希缓存在 session state 中）"""
+    rules = st.session_state[mapping_name]
+    key = mapping_rules_key(rules, "原始来源", target_field)
+    cache_name = f"{mapping_name}_text_index"
+    cached = st.session_state.get(cache_name)
+    if cached is None or cached['key'] != key:
+        cached = {'key': key, 'index': build_source_index(rules, target_field)}
+        st.session_state[cache_name] = cached
+    return cached['index']
+
+# 合并只用到少量列，读取时按表头筛选，只加载这些列
+YICHE_COLUMNS = ['客户姓名', '客户手机', '车系', '意向车系', 'BMD二级渠道', '二级渠道']
+# 汽车之家车系列的候选列名（按顺序匹配，忽略空格）
+AUTOHOME_CAR_SERIES_CANDIDATES = ['意向车系车型', '意向车系', '车系', '线索意向车型车系', '车型']
+# 线索创建时间的候选列名（增量合并按此列记录水位）
+SOURCE_TIMESTAMP_CANDIDATES = ['线索创建时间', '创建时间', '留资时间', '下发时间']
+
+def yiche_usecols(col):
+    """易车网需要读取的列"""
+    return str(col) in YICHE_COLUMNS or str(col).strip() in SOURCE_TIMESTAMP_CANDIDATES
+
+def autohome_usecols(col):
+    """汽车之家需要读取的列：姓名、号码以及所有可能的车系列（忽略空格匹配）"""
+    name = str(col)
+    if name in ('客户姓名', '客户号码') or name.strip() in SOURCE_TIMESTAMP_CANDIDATES:
+        return True
+    name_clean = name.strip().replace(' ', '')
+    return any(cand.replace(' ', '') == name_clean for cand in AUTOHOME_CAR_SERIES_CANDIDATES)
+
+# 上传文件内容哈希
+def get_upload_hash(uploaded):
+    """获取上传文件内容的 SHA-256（同一上传文件只计算一次）"""
+    hashes = st.session_state.upload_hashes
+    file_key = (getattr(uploaded, 'file_id', None) or uploaded.name, uploaded.size)
+    if file_key not in hashes:
+        hashes[file_key] = hashlib.sha256(uploaded.getvalue()).hexdigest()
+    return hashes[file_key]
+
+class RepairedCSVStream(io.TextIOBase):
+    """把逐行修复的文本包装成可读的文本流，供 pd.read_csv 直接读取"""
+
+    def __init__(self, pieces):
+        self._pieces = pieces
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            text = self._buffer + ''.join(self._pieces)
+            self._buffer = ''
+            return text
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for piece in self._pieces:
+            chunks.append(piece)
+            length += len(piece)
+            if length >= size:
+                break
+        text = ''.join(chunks)
+        self._buffer = text[size:]
+        return text[:size]
+
+REPAIR_PARALLEL_MIN_BYTES = 32 * 1024 * 1024   # 小于该大小时进程池启动开销大于收益，直接串行
+REPAIR_CHUNKS_PER_WORKER = 4
+# 只有这些编码的多字节字符不含 0x0A 字节，可以直接按换行字节切段；utf-16 等其余编码只能串行修复
+NEWLINE_SAFE_ENCODINGS = ('utf-8', 'utf-8-sig', 'gbk', 'gb18030')
+
+# 子进程启动时会按 __main__ 的 __spec__ 或 __file__ 重新导入主模块；Streamlit 运行时本脚本就是 __main__，
+# 标明它是 __main__ 模块本身后，子进程不会把整个页面脚本再执行一遍（子进程需要的函数都在 csv_repair 中）
+__spec__ = importlib.machinery.ModuleSpec('__main__', None)
+
+def repair_encoding(data):
+    """检测待修复CSV的编码"""
+    encoding = detect_encoding(data, "待修复CSV")
+    return 'utf-8-sig' if encoding == 'utf-8' else encoding
+
+def split_at_newlines(data, parts):
+    """把字节切成约 parts 段，切点都在换行符之后
+
+    只适用于 NEWLINE_SAFE_ENCODINGS：这些编码的多字节字符不会包含 0x0A，切点才一定落在字符和行的边界上。
+    """
+    size = max(len(data) // parts, 1)
+    bounds = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + size)
+        end = len(data) if end == -1 else end + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+def iter_repaired_parallel(data, encoding, errors, workers):
+    """按换行切段后在进程池中并行修复，按原顺序产出各段结果
+
+    使用 forkserver：工作进程从预先导入 csv_repair 的单线程服务进程复制，而不是从多线程的 Streamlit 服务器 fork；
+    repair_csv_chunk 按 csv_repair 模块名序列化，不依赖 Streamlit 每次运行都会替换的 __main__。
+    """
+    bounds = split_at_newlines(data, workers * REPAIR_CHUNKS_PER_WORKER)
+    # BOM 只可能出现在文件开头，后续分段按普通 utf-8 解码
+    body_encoding = 'utf-8' if encoding == 'utf-8-sig' else encoding
+    chunks = (data[start:end] for start, end in bounds)
+    encodings = [encoding] + [body_encoding] * (len(bounds) - 1)
+    headers = [True] + [False] * (len(bounds) - 1)
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['csv_repair'])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        yield from pool.map(repair_csv_chunk, chunks, encodings, [errors] * len(bounds), headers)
+
+def iter_repaired(data, encoding, errors='strict'):
+    """根据文件大小和并行设置选择串行或并行修复，两者输出完全一致"""
+    workers = int(st.session_state.repair_workers)
+    parallel = (workers > 1 and len(data) >= REPAIR_PARALLEL_MIN_BYTES
+                and encoding in NEWLINE_SAFE_ENCODINGS
+                and 'forkserver' in multiprocessing.get_all_start_methods())
+    if not parallel:
+        return iter_repaired_csv(data, encoding, errors)
+    add_log(f"CSV修复: 并行模式，{workers} 个进程")
+    return iter_repaired_parallel(data, encoding, errors, workers)
+
+def fix_csv_format(file_content):
+    """修复CSV格式问题，返回修复后的完整文本（仅在下载时调用）"""
+    encoding = repair_encoding(file_content)
+    try:
+        return ''.join(iter_repaired(file_content, encoding))
+    except UnicodeDecodeError:
+        add_log(f"按 {encoding} 解码失败，改为 utf-8 忽略错误字节")
+        return ''.join(iter_repaired(file_content, 'utf-8', 'ignore'))
+
+def read_repaired_csv(file_content):
+    """边修复边解析，直接得到修复后的 DataFrame"""
+    encoding = repair_encoding(file_content)
+    try:
+        return pd.read_csv(RepairedCSVStream(iter_repaired(file_content, encoding)), usecols=yiche_usecols)
+    except UnicodeDecodeError:
+        add_log(f"按 {encoding} 解码失败，改为 utf-8 忽略错误字节")
+        return pd.read_csv(RepairedCSVStream(iter_repaired(file_content, 'utf-8', 'ignore')), usecols=yiche_usecols)
+
+# 合并结果缓存：相同的文件和配置再次合并时直接返回上次结果（侧边栏显示缓存条数，需在侧边栏之前定义）
+MERGE_MEMO_MAX_ENTRIES = 4   # 合并结果缓存最多保留的条数
+
+def leads_db_state():
+    """台账、历史库和水位的版本标记：记入台账或重置水位后变化"""
+    with closing(open_leads_db()) as conn:
+        runs = conn.execute("SELECT COUNT(*), MAX(created_at) FROM allocation_runs").fetchone()
+        marks = conn.execute("SELECT COUNT(*), MAX(updated_at) FROM source_watermarks").fetchone()
+    return list(runs) + list(marks)
+
+def merge_memo_key(input_hashes, selected_consultants, first_consultant, ledger_counts, options):
+    """由上传内容哈希、三类映射规则哈希、启用的顾问（含单位）、第一条顾问、种子和其他选项计算缓存键"""
+    unit_index = build_consultant_unit_index()
+    payload = {
+        'inputs': input_hashes,
+        'rules': [
+            mapping_rules_key(st.session_state.car_series_mapping, "原始模式", "目标车系"),
+            mapping_rules_key(st.session_state.source_category_mapping, "原始来源", "目标分类"),
+            mapping_rules_key(st.session_state.source_detail_mapping, "原始来源", "目标线索来源"),
+        ],
+        'consultants': [[name, unit_index.get(name, "")] for name in selected_consultants],
+        'first_consultant': first_consultant,
+        'ledger': ledger_counts,
+        'options': options,
+    }
+    # 依赖本地数据库（台账、历史去重、水位）时，数据库变化后缓存失效
+    if ledger_counts is not None or options.get('skip_exported') or options.get('incremental'):
+        payload['db_state'] = leads_db_state()
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def get_merge_memo(key):
+    memo = st.session_state.merge_memo
+    if key not in memo:
+        return None
+    memo.move_to_end(key)
+    return memo[key]
+
+def store_merge_memo(key, df_result, pending_watermarks, merge_state):
+    memo = st.session_state.merge_memo
+    memo[key] = (df_result, pending_watermarks, merge_state)
+    while len(memo) > MERGE_MEMO_MAX_ENTRIES:
+        memo.popitem(last=False)
+
+# calamine 读取引擎需要 pandas 2.2 及以上，并安装可选依赖 python-calamine
+CALAMINE_MIN_PANDAS = (2, 2)
+
+def calamine_available():
+    """当前环境能否使用 calamine 读取Excel"""
+    pandas_version = tuple(int(part) for part in re.findall(r'\d+', pd.__version__)[:2])
+    return pandas_version >= CALAMINE_MIN_PANDAS and importlib.util.find_spec("python_calamine") is not None
 
 # 侧边栏配置
 st.sidebar.header("⚙️ 配置选项")
@@ -140,98 +629,37 @@ uploaded_file = st.sidebar.file_uploader(
 if uploaded_file is not None:
     st.sidebar.success(f"已上传: {uploaded_file.name}")
     
-    # 修复CSV格式的函数
-    def fix_csv_format(file_content):
-        """修复CSV格式问题"""
-        try:
-            # 尝试多种方式读取
-            content = file_content.decode('utf-8-sig')
-        except:
-            try:
-                content = file_content.decode('gbk')
-            except:
-                content = file_content.decode('utf-8', errors='ignore')
-        
-        lines = content.splitlines()
-        processed_lines = []
-        
-        for i, line in enumerate(lines):
-            line = line.strip()
-            
-            if i == 0:
-                # 标题行
-                processed_lines.append(line)
-                continue
-            
-            if not line:  # 跳过空行
-                continue
-            
-            # 处理引号
-            if line.startswith('"') and line.endswith('"'):
-                line = line[1:-1]
-            
-            # 处理转义的双引号
-            line = line.replace('""', 'TEMP_QUOTE')
-            
-            # 分割字段
-            parts = []
-            current_part = []
-            in_quotes = False
-            
-            for char in line:
-                if char == '"' and not in_quotes:
-                    in_quotes = True
-                elif char == '"' and in_quotes:
-                    in_quotes = False
-                elif char == ',' and not in_quotes:
-                    parts.append(''.join(current_part))
-                    current_part = []
-                else:
-                    current_part.append(char)
-            
-            if current_part:
-                parts.append(''.join(current_part))
-            
-            # 恢复转义的双引号
-            processed_parts = []
-            for part in parts:
-                if part.startswith('"') and part.endswith('"'):
-                    part = part[1:-1]
-                part = part.replace('TEMP_QUOTE', '"')
-                processed_parts.append(part)
-            
-            processed_lines.append(','.join(processed_parts))
-        
-        return '\n'.join(processed_lines)
-    
     # 显示修复选项
     if st.sidebar.button("修复文件格式"):
         try:
-            fixed_content = fix_csv_format(uploaded_file.getvalue())
+            # 边修复边读取到DataFrame
+            fixed_df = read_repaired_csv(uploaded_file.getvalue())
+            st.session_state.fixed_yiche_df = fixed_df
+            st.session_state.fixed_yiche_hash = get_upload_hash(uploaded_file)
+            st.sidebar.success(f"文件格式修复完成！共 {len(fixed_df)} 条记录")
             
-            # 读取修复后的内容到DataFrame
-            try:
-                fixed_df = pd.read_csv(io.StringIO(fixed_content))
-                st.session_state.fixed_yiche_df = fixed_df
-                
-                # 提供下载修复后的文件
-                st.sidebar.download_button(
-                    label="下载修复后的文件",
-                    data=fixed_content,
-                    file_name=f"fixed_{uploaded_file.name}",
-                    mime="text/csv"
-                )
-                st.sidebar.success(f"文件格式修复完成！共 {len(fixed_df)} 条记录")
-                
-                # 显示修复后的数据预览
-                with st.sidebar.expander("查看修复后的数据预览"):
-                    st.dataframe(fixed_df.head(5))
-                    
-            except Exception as e:
-                st.sidebar.error(f"读取修复后的文件失败: {str(e)}")
+            # 显示修复后的数据预览
+            with st.sidebar.expander("查看修复后的数据预览"):
+                st.dataframe(fixed_df.head(5))
                 
         except Exception as e:
             st.sidebar.error(f"修复失败: {str(e)}")
+    
+    # 修复后的文件只在需要下载时生成，并按内容哈希缓存
+    if st.session_state.fixed_yiche_df is not None:
+        upload_hash = get_upload_hash(uploaded_file)
+        fixed_csv = st.session_state.get('fixed_yiche_csv')
+        if fixed_csv is None or fixed_csv['hash'] != upload_hash:
+            if st.sidebar.button("生成修复后的文件"):
+                fixed_csv = {'hash': upload_hash, 'data': fix_csv_format(uploaded_file.getvalue()).encode('utf-8')}
+                st.session_state.fixed_yiche_csv = fixed_csv
+        if fixed_csv is not None and fixed_csv['hash'] == upload_hash:
+            st.sidebar.download_button(
+                label="下载修复后的文件",
+                data=fixed_csv['data'],
+                file_name=f"fixed_{uploaded_file.name}",
+                mime="text/csv"
+            )
 
 # 2. 映射规则管理
 with st.sidebar.expander("🗺️ 映射规则管理", expanded=False):
@@ -254,8 +682,16 @@ with st.sidebar.expander("🗺️ 映射规则管理", expanded=False):
         col1, col2 = st.columns(2)
         with col1:
             if st.button("💾 保存车系规则", use_container_width=True, key="save_car_mapping"):
-                st.session_state.car_series_mapping = edited_car_df.to_dict('records')
-                st.success("车系映射规则已更新！")
+                new_car_rules = edited_car_df.to_dict('records')
+                rule_errors = validate_car_series_rules(new_car_rules)
+                if rule_errors:
+                    for error in rule_errors:
+                        st.error(error)
+                    st.warning("车系映射规则未保存，请修正后重试")
+                else:
+                    st.session_state.car_series_mapping = new_car_rules
+                    get_car_series_matcher()
+                    st.success("车系映射规则已更新！")
         
         with col2:
             if st.button("🔄 恢复默认", use_container_width=True, key="reset_car_mapping"):
@@ -417,13 +853,21 @@ with st.sidebar.expander("🗺️ 映射规则管理", expanded=False):
         if uploaded_mappings:
             try:
                 new_mappings = json.load(uploaded_mappings)
-                if "car_series_mapping" in new_mappings:
-                    st.session_state.car_series_mapping = new_mappings["car_series_mapping"]
-                if "source_category_mapping" in new_mappings:
-                    st.session_state.source_category_mapping = new_mappings["source_category_mapping"]
-                if "source_detail_mapping" in new_mappings:
-                    st.session_state.source_detail_mapping = new_mappings["source_detail_mapping"]
-                st.success("映射规则导入成功！")
+                # 与保存车系规则相同的校验：有无效正则时整个文件都不导入
+                rule_errors = validate_car_series_rules(new_mappings.get("car_series_mapping", []))
+                if rule_errors:
+                    for error in rule_errors:
+                        st.error(error)
+                    st.warning("规则文件未导入，请修正车系规则后重试")
+                else:
+                    if "car_series_mapping" in new_mappings:
+                        st.session_state.car_series_mapping = new_mappings["car_series_mapping"]
+                        get_car_series_matcher()
+                    if "source_category_mapping" in new_mappings:
+                        st.session_state.source_category_mapping = new_mappings["source_category_mapping"]
+                    if "source_detail_mapping" in new_mappings:
+                        st.session_state.source_detail_mapping = new_mappings["source_detail_mapping"]
+                    st.success("映射规则导入成功！")
             except Exception as e:
                 st.error(f"导入失败: {str(e)}")
 
@@ -466,6 +910,78 @@ with st.sidebar.expander("👥 销售人员管理", expanded=False):
             ]
             st.success("已恢复默认设置！")
 
+# 性能设置
+with st.sidebar.expander("⚡ 性能设置", expanded=False):
+    st.session_state.upload_cache_max_mb = st.number_input(
+        "上传文件缓存上限 (MB)",
+        min_value=64,
+        max_value=16384,
+        value=int(st.session_state.upload_cache_max_mb),
+        step=64,
+        help="已解析的上传文件按内容哈希缓存，超过上限时淘汰最久未使用的文件",
+        key="upload_cache_max_mb_input"
+    )
+    cache_bytes = sum(size for _, size in st.session_state.upload_cache.values())
+    st.caption(f"已缓存 {len(st.session_state.upload_cache)} 个解析结果，占用 {cache_bytes / 1024 / 1024:.1f} MB")
+    st.session_state.yiche_streaming = st.checkbox(
+        "易车网CSV分块流式处理",
+        value=st.session_state.yiche_streaming,
+        help="适用于几百万行的大文件：按块读取、清洗、映射，内存占用只取决于块大小",
+        key="yiche_streaming_input"
+    )
+    st.session_state.yiche_chunk_rows = st.number_input(
+        "每块行数",
+        min_value=1000,
+        max_value=2000000,
+        value=int(st.session_state.yiche_chunk_rows),
+        step=10000,
+        disabled=not st.session_state.yiche_streaming,
+        key="yiche_chunk_rows_input"
+    )
+    st.session_state.repair_workers = st.number_input(
+        "CSV修复并行进程数",
+        min_value=1,
+        max_value=max(os.cpu_count() or 1, 1) * 2,
+        value=int(st.session_state.repair_workers),
+        step=1,
+        help=f"大于 {REPAIR_PARALLEL_MIN_BYTES // 1024 // 1024}MB 的文件按行切段并行修复，结果与串行完全一致；设为 1 始终串行",
+        key="repair_workers_input"
+    )
+    # calamine 不可用时不提供该选项
+    excel_engine_options = ["自动", "calamine", "openpyxl"] if calamine_available() else ["自动", "openpyxl"]
+    if st.session_state.excel_engine not in excel_engine_options:
+        st.session_state.excel_engine = "自动"
+    st.session_state.excel_engine = st.selectbox(
+        "Excel读取引擎",
+        excel_engine_options,
+        index=excel_engine_options.index(st.session_state.excel_engine),
+        help="自动：pandas 2.2 及以上且已安装 python-calamine 时使用 calamine，否则使用 openpyxl 只读流式读取",
+        key="excel_engine_input"
+    )
+    bloom_fpr_options = [0.001, 0.01, 0.05]
+    st.session_state.bloom_fpr = st.selectbox(
+        "历史号码布隆过滤误判率",
+        bloom_fpr_options,
+        index=bloom_fpr_options.index(st.session_state.bloom_fpr),
+        format_func=lambda rate: f"{rate:.1%}",
+        help="误判率越低，过滤器文件越大；修改后下次历史去重时自动重建",
+        key="bloom_fpr_input"
+    )
+    st.session_state.trace_export_memory = st.checkbox(
+        "导出时统计峰值内存",
+        value=st.session_state.trace_export_memory,
+        help="生成下载文件时用 tracemalloc 记录峰值内存并写入处理日志；统计本身会让导出变慢",
+        key="trace_export_memory_input"
+    )
+    if st.button("🧹 清空解析缓存", use_container_width=True, key="clear_upload_cache"):
+        st.session_state.upload_cache.clear()
+        st.session_state.upload_hashes.clear()
+        st.success("解析缓存已清空！")
+    st.caption(f"合并结果缓存 {len(st.session_state.merge_memo)} / {MERGE_MEMO_MAX_ENTRIES} 项")
+    if st.button("🧹 清空合并结果缓存", use_container_width=True, key="clear_merge_memo"):
+        st.session_state.merge_memo.clear()
+        st.success("合并结果缓存已清空！")
+
 # 4. 销售线索合并配置
 st.sidebar.subheader("2. 合并配置")
 
@@ -478,6 +994,13 @@ with col1:
 with col2:
     autohome_file = st.file_uploader("汽车之家文件 (Excel)", type=['xlsx', 'xls'], key="autohome_file")
 
+st.session_state.incremental_merge = st.sidebar.checkbox(
+    "增量合并（只处理新增的行）",
+    value=st.session_state.incremental_merge,
+    help="平台导出的是累计文件时使用：按创建时间（或上次上传的行哈希）跳过已处理的行，记入分配台账时更新水位",
+    key="incremental_merge_input"
+)
+
 # 销售顾问选择
 st.sidebar.subheader("销售顾问分配")
 
@@ -504,6 +1027,27 @@ if selected_consultants:
     
     if first_consultant == "自动分配":
         first_consultant = ""
+    
+    st.session_state.use_allocation_ledger = st.sidebar.checkbox(
+        "按分配台账平衡余数",
+        value=st.session_state.use_allocation_ledger,
+        help="根据历史累计分配数，把每次的轮询起点和余数分给累计较少的顾问（结果页点击“记入分配台账”后累计）",
+        key="use_allocation_ledger_input"
+    )
+    st.session_state.skip_exported_phones = st.sidebar.checkbox(
+        "排除历史已导出号码",
+        value=st.session_state.skip_exported_phones,
+        help="已记入台账的手机号不再重复分配（跨天、跨批次去重）",
+        key="skip_exported_phones_input"
+    )
+    st.session_state.allocation_seed = st.sidebar.number_input(
+        "余数分配随机种子",
+        min_value=0,
+        value=int(st.session_state.allocation_seed),
+        step=1,
+        help="0 表示每个会话随机抽取一个种子（同一会话内相同输入直接使用缓存，新会话重新随机）；固定种子后相同输入的分配结果跨会话可复现（启用分配台账时余数分给累计较少的顾问，累计相同时按此种子随机）",
+        key="allocation_seed_input"
+    )
 else:
     st.sidebar.warning("请至少选择一个销售顾问")
     first_consultant = ""
@@ -525,6 +1069,196 @@ def remove_after_slash(value):
         return value_str[:sep_pos].strip()
     return value_str
 
+def remove_after_slash_column(values):
+    """整列版 remove_after_slash：结果与逐行调用完全一致"""
+    missing = values.isna().to_numpy()
+    value_str = values.astype(str).astype(object).str.strip()
+    # 有 '/' 时按 '/' 截断，否则按 '+' 截断（与逐行版本的查找顺序相同）
+    has_slash = value_str.str.contains('/', regex=False)
+    before_slash = value_str.str.split('/', n=1, regex=False).str[0]
+    before_plus = value_str.str.split('+', n=1, regex=False).str[0]
+    cleaned = before_slash.where(has_slash, before_plus).str.strip()
+    return cleaned.mask(missing, '')
+
+# 手机号规范化：统一为 11 位手机号作为去重键
+MOBILE_PATTERN = re.compile(r'1[3-9]\d{9}')
+PHONE_SCIENTIFIC = re.compile(r'\d(?:\.\d+)?[eE]\+?\d+')   # Excel 转成数字后的 1.38001380000E10
+PHONE_FLOAT_SUFFIX = re.compile(r'^(\d+)\.0*$')   # 13800138000.0
+PHONE_COUNTRY_CODE = re.compile(r'^\s*\(?\s*(?:\+|00)\s*86\s*\)?[\s-]*')
+PHONE_SEPARATOR_TAIL = re.compile(r'[/+].*')   # 多个号码时取第一个
+PHONE_NON_DIGIT = re.compile(r'\D')
+PHONE_DOMESTIC_PREFIX = re.compile(r'^(?:0086|86)(1\d{10})$')
+
+def normalize_phone_column(values):
+    """整列规范化手机号，返回 (手机号列, 是否为有效手机号)
+
+    有效手机号统一为 11 位数字（去掉空格、横线、+86/0086 前缀、Excel 浮点格式）；
+    无效号码保留 remove_after_slash 的清洗结果，不丢弃线索。
+    """
+    missing = values.isna().to_numpy()
+    # 标准 11 位号码走快速路径（pandas 字符串类型由 Arrow 支持时整列在 C++ 中完成匹配）
+    text = values.astype(str).str.strip()
+    valid = np.array(text.str.fullmatch(MOBILE_PATTERN).fillna(False), dtype=bool) & ~missing
+    phones = np.array(text.astype(object), dtype=object)
+    phones[missing] = ''
+    rest_mask = ~valid & ~missing
+    if not rest_mask.any():
+        return pd.Series(phones, index=values.index, dtype=object), valid
+    # 其余号码（通常只占少数）逐步清洗
+    rest = values[rest_mask]
+    text = rest.astype(str).str.strip()
+    scientific = np.array(text.str.fullmatch(PHONE_SCIENTIFIC).fillna(False), dtype=bool)
+    if scientific.any():
+        text[scientific] = pd.to_numeric(text[scientific]).map('{:.0f}'.format)
+    text = text.str.replace(PHONE_FLOAT_SUFFIX, r'\1', regex=True)
+    text = text.str.replace(PHONE_COUNTRY_CODE, '', regex=True)
+    text = text.str.replace(PHONE_SEPARATOR_TAIL, '', regex=True)
+    digits = text.str.replace(PHONE_NON_DIGIT, '', regex=True)
+    digits = digits.str.replace(PHONE_DOMESTIC_PREFIX, r'\1', regex=True)
+    rest_valid = np.array(digits.str.fullmatch(MOBILE_PATTERN).fillna(False), dtype=bool)
+    rest_phones = np.array(digits.astype(object), dtype=object)
+    if not rest_valid.all():
+        rest_phones[~rest_valid] = remove_after_slash_column(rest[~rest_valid]).to_numpy(dtype=object)
+    phones[rest_mask] = rest_phones
+    valid[rest_mask] = rest_valid
+    return pd.Series(phones, index=values.index, dtype=object), valid
+
+def get_column(df, col, default=''):
+    """按列名取列，缺失时返回填充默认值的列（等价于逐行 row.get(col, default)）"""
+    if col in df.columns:
+        return df[col]
+    return pd.Series(default, index=df.index, dtype=object)
+
+def factorize_column(values):
+    """对列做字典编码，返回 (整数编码, 唯一值列表)；缺失值统一编码为最后一个唯一值"""
+    # 映射函数只依赖 pd.isna(value) 与 str(value)，按字符串形式编码与逐行调用结果一致
+    missing = values.isna().to_numpy()
+    codes, uniques = pd.factorize(values.astype(str).where(~missing))
+    uniques = list(uniques)
+    if missing.any():
+        codes = np.where(codes == -1, len(uniques), codes)
+        uniques.append(np.nan)
+    return codes, uniques
+
+def map_by_codes(codes, uniques, func, memo=None):
+    """每个唯一值只调用一次 func，再通过整数编码回填到整列
+
+    memo 可在多次调用（如分块处理）之间共享，已计算过的值不再重复调用 func。
+    """
+    if memo is None:
+        memo = {}
+    mapped = np.empty(len(uniques), dtype=object)
+    for i, value in enumerate(uniques):
+        key = value if isinstance(value, str) else None   # 缺失值统一记为 None
+        if key not in memo:
+            memo[key] = func(value)
+        mapped[i] = memo[key]
+    return mapped[codes]
+
+def memo_keys(uniques):
+    """唯一值在 map_by_codes 映射表中的键"""
+    keys = np.empty(len(uniques), dtype=object)
+    keys[:] = [value if isinstance(value, str) else None for value in uniques]
+    return keys
+
+def count_values(counter, uniques, codes):
+    """按映射表的键累计每个唯一值出现的行数（用于规则命中统计）"""
+    for key, count in zip(memo_keys(uniques), np.bincount(codes, minlength=len(uniques))):
+        counter[key] += int(count)
+
+def build_lead_columns(names, phones, source_category, source_detail, car_series):
+    """按输出列顺序整列组装一批线索：逐行变化的列是 object 数组，常量列只存一个标量"""
+    return {
+        '姓名': names.to_numpy(dtype=object),
+        '手机号': phones.to_numpy(dtype=object),
+        '性别': '',
+        '来源分类': np.asarray(source_category, dtype=object) if np.ndim(source_category) else source_category,
+        '线索来源': np.asarray(source_detail, dtype=object) if np.ndim(source_detail) else source_detail,
+        '备注': '',
+        '意向品牌': '别克',
+        '意向车系': np.asarray(car_series, dtype=object),
+        '销售顾问': '',
+        '单位': '',
+        '跟进内容': ''
+    }
+
+def lead_count(batch):
+    """一批线索的行数（姓名列总是逐行存储）"""
+    return len(batch['姓名'])
+
+def lead_column(batch, column):
+    """取出一列的逐行数组，常量列按行数展开"""
+    value = batch[column]
+    if np.ndim(value):
+        return value
+    return np.full(lead_count(batch), value, dtype=object)
+
+def concat_lead_batches(batches):
+    """按列拼接多批线索；各批取值相同的常量列仍保持为标量"""
+    merged = {}
+    for column, value in batches[0].items():
+        values = [batch[column] for batch in batches]
+        if all(not np.ndim(v) for v in values) and all(v == value for v in values):
+            merged[column] = value
+        else:
+            merged[column] = np.concatenate([lead_column(batch, column) for batch in batches])
+    return merged
+
+def take_leads(batch, mask):
+    """按布尔掩码筛选线索，只复制逐行列"""
+    return {column: value[mask] if np.ndim(value) else value for column, value in batch.items()}
+
+def output_categories():
+    """低基数输出列的类别：取自映射规则目标、映射默认值和顾问设置"""
+    def targets(rule_key, target_column):
+        return [rule[target_column] for rule in st.session_state.get(rule_key, []) if rule[target_column] != "排除"]
+    consultants = st.session_state.consultant_settings
+    return {
+        '来源分类': targets("source_category_mapping", "目标分类") + ["垂媒", "其他"],
+        '线索来源': targets("source_detail_mapping", "目标线索来源") + ["汽车之家", ""],
+        '意向品牌': ["别克"],
+        '意向车系': targets("car_series_mapping", "目标车系") + ["昂科威PLUS"],
+        '销售顾问': [consultant["姓名"] for consultant in consultants] + [""],
+        '单位': [consultant["单位"] for consultant in consultants] + [""],
+    }
+
+def to_categorical(values, categories, n=None):
+    """按给定类别编码一列（标量按 n 行展开）；不在类别中的值追加为新类别"""
+    categories = [value for value in dict.fromkeys(categories) if isinstance(value, str)]
+    position = {value: i for i, value in enumerate(categories)}
+    if np.ndim(values):
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    elif pd.isna(values):
+        codes, uniques = np.full(n, -1, dtype=np.intp), []
+    else:
+        codes, uniques = np.zeros(n, dtype=np.intp), [values]
+    lookup = np.empty(len(uniques), dtype=np.intp)
+    for i, value in enumerate(uniques):
+        if value not in position:
+            position[value] = len(categories)
+            categories.append(value)
+        lookup[i] = position[value]
+    codes = np.where(codes >= 0, lookup[codes], -1) if len(uniques) else codes
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def leads_to_frame(batch, columns, categories=None):
+    """把线索批次一次性物化为 DataFrame（只包含 columns 指定的列）；categories 中的列直接编码为分类类型"""
+    categories = categories or {}
+    return pd.DataFrame({
+        column: to_categorical(batch[column], categories[column], lead_count(batch))
+        if column in categories else lead_column(batch, column)
+        for column in columns
+    })
+
+def category_counts(column):
+    """按分类编码统计各值条数（只保留出现过的值，按条数降序）；非分类列退回 value_counts"""
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        return column.value_counts()
+    codes = column.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories))
+    stats = pd.Series(counts, index=pd.Index(column.cat.categories, name=column.name), name='count')
+    return stats[stats > 0].sort_values(ascending=False, kind='stable')
+
 def get_consultant_unit(consultant_name):
     """获取顾问所属单位"""
     # 从设置中查找单位
@@ -533,29 +1267,24 @@ def get_consultant_unit(consultant_name):
             return consultant["单位"]
     return ""
 
-def normalize_car_series(car_series, default_value="昂科威PLUS", original_source=None):
-    """标准化车系名称 - 使用可配置的映射规则"""
+def normalize_car_series(car_series, default_value="昂科威PLUS", original_source=None, matcher=None):
+    """标准化车系名称 - 使用可配置的映射规则（预编译，先匹配先生效）"""
     if pd.isna(car_series) or str(car_series).strip() == '':
         return default_value
     
     original = str(car_series).strip()
     
-    # 使用可配置的映射规则
-    for mapping_rule in st.session_state.car_series_mapping:
-        if mapping_rule["是否启用"]:
-            pattern = mapping_rule["原始模式"]
-            try:
-                if re.search(pattern, original, re.IGNORECASE):
-                    return mapping_rule["目标车系"]
-            except re.error:
-                # 如果正则表达式无效，尝试字符串包含匹配
-                if pattern in original or original in pattern:
-                    return mapping_rule["目标车系"]
+    # 使用编译后的映射规则
+    if matcher is None:
+        matcher = get_car_series_matcher()
+    found, target = match_car_series(matcher, original)
+    if found:
+        return target
     
     return default_value
 
-def map_source_category(source_value):
-    """映射来源分类 - 使用可配置的映射规则"""
+def map_source_category(source_value, index=None):
+    """映射来源分类 - 使用可配置的映射规则（双向包含索引，先匹配先生效）"""
     if pd.isna(source_value):
         return "其他"
     
@@ -563,22 +1292,17 @@ def map_source_category(source_value):
     if not source_str:
         return "其他"
     
-    # 使用可配置的映射规则
-    for mapping_rule in st.session_state.source_category_mapping:
-        if mapping_rule["是否启用"]:
-            original_source = mapping_rule["原始来源"]
-            # 精确匹配或模糊匹配
-            if original_source == source_str or original_source in source_str or source_str in original_source:
-                target = mapping_rule["目标分类"]
-                # 如果目标分类为"排除"，返回特殊标记
-                if target == "排除":
-                    return "排除"
-                return target
+    # 使用可配置的映射规则；目标为"排除"时原样返回作为特殊标记
+    if index is None:
+        index = get_source_index("source_category_mapping", "目标分类")
+    found, target = lookup_source_index(index, source_str)
+    if found:
+        return target
     
     return "其他"
 
-def map_source_detail(source_value):
-    """映射线索来源 - 使用可配置的映射规则"""
+def map_source_detail(source_value, index=None):
+    """映射线索来源 - 使用可配置的映射规则（双向包含索引，先匹配先生效）"""
     if pd.isna(source_value):
         return ""
     
@@ -586,27 +1310,492 @@ def map_source_detail(source_value):
     if not source_str:
         return ""
     
-    # 使用可配置的映射规则
-    for mapping_rule in st.session_state.source_detail_mapping:
-        if mapping_rule["是否启用"]:
-            original_source = mapping_rule["原始来源"]
-            # 精确匹配或模糊匹配
-            if original_source == source_str or original_source in source_str or source_str in original_source:
-                target = mapping_rule["目标线索来源"]
-                # 如果目标线索来源为"排除"，返回特殊标记
-                if target == "排除":
-                    return "排除"
-                return target
+    # 使用可配置的映射规则；目标为"排除"时原样返回作为特殊标记
+    if index is None:
+        index = get_source_index("source_detail_mapping", "目标线索来源")
+    found, target = lookup_source_index(index, source_str)
+    if found:
+        return target
     
     return ""
 
-def fair_allocate_consultants(records, selected_consultants_dict, first_consultant=None):
-    """公平分配销售顾问，剩余线索随机分配"""
+# 本地持久化数据（分配台账等）
+LEADS_DB_PATH = os.environ.get(
+    "SALES_LEADS_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sales_leads.db")
+)
+
+def open_leads_db():
+    """打开本地 SQLite 数据库，按需建表"""
+    os.makedirs(os.path.dirname(LEADS_DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(LEADS_DB_PATH)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS allocation_ledger (
+            consultant TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS allocation_runs (
+            run_key TEXT PRIMARY KEY,
+            leads INTEGER NOT NULL,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS lead_history (
+            phone TEXT PRIMARY KEY,
+            consultant TEXT,
+            exported_at TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS source_watermarks (
+            source TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            max_ts TEXT,
+            row_hashes BLOB,
+            rows INTEGER NOT NULL,
+            updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS watermark_rows (
+            source TEXT NOT NULL,
+            row_hash INTEGER NOT NULL,
+            PRIMARY KEY (source, row_hash)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS bloom_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            bits INTEGER NOT NULL,
+            hashes INTEGER NOT NULL,
+            capacity INTEGER NOT NULL,
+            items INTEGER NOT NULL,
+            fpr REAL NOT NULL
+        );
+    """)
+    return conn
+
+def dataframe_fingerprint(df):
+    """按内容计算 DataFrame 指纹（列名 + 各行哈希）"""
+    digest = hashlib.sha256(json.dumps(list(df.columns), ensure_ascii=False).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def merged_fingerprint(df):
+    """当前合并结果的指纹；同一个结果对象只计算一次"""
+    cached = st.session_state.merged_fingerprint
+    if cached is not None and cached[0] is df:
+        return cached[1]
+    fingerprint = dataframe_fingerprint(df)
+    st.session_state.merged_fingerprint = (df, fingerprint)
+    return fingerprint
+
+EXCEL_WRITE_BATCH_ROWS = 10000   # 流式写 Excel 时每批转换的行数
+
+def excel_values(column):
+    """一列转换为可写入单元格的 Python 值，缺失值写成空单元格"""
+    values = column.to_numpy(dtype=object)
+    values[pd.isna(values)] = None
+    return values.tolist()
+
+def build_excel_export(df):
+    """合并结果导出为 Excel 文件字节：openpyxl 只写模式按批流式写入，行数据先落到临时文件，内存占用与行数无关"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('合并结果')
+    sheet.append([str(column) for column in df.columns])
+    for start in range(0, len(df), EXCEL_WRITE_BATCH_ROWS):
+        batch = df.iloc[start:start + EXCEL_WRITE_BATCH_ROWS]
+        for row in zip(*(excel_values(batch[column]) for column in df.columns)):
+            sheet.append(row)
+    with tempfile.TemporaryFile() as spill:
+        workbook.save(spill)
+        spill.seek(0)
+        return spill.read()
+
+def build_csv_export(df):
+    """合并结果导出为带 BOM 的 UTF-8 CSV 字节（Excel 可直接打开）"""
+    return df.to_csv(index=False).encode('utf-8-sig')
+
+EXPORT_SPLIT_WORKERS = min(os.cpu_count() or 1, 8)   # 按顾问拆分导出时并行写文件的线程数
+INVALID_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+def build_split_export(df, builder, extension):
+    """按销售顾问拆分导出：一次分组，线程池为每位顾问生成一个文件，依次写入 ZIP（先落到临时文件）"""
+    groups = df.groupby('销售顾问', observed=True, sort=False).indices
+    
+    def write_group(item):
+        consultant, rows = item
+        return consultant, builder(df.iloc[rows])
+    
+    # xlsx 本身已压缩，只有 CSV 需要再压缩（用最快的压缩级别）
+    compression = zipfile.ZIP_STORED if extension == 'xlsx' else zipfile.ZIP_DEFLATED
+    with tempfile.TemporaryFile() as spill:
+        with ThreadPoolExecutor(max_workers=EXPORT_SPLIT_WORKERS) as pool, zipfile.ZipFile(spill, 'w', compression, compresslevel=1) as archive:
+            used_names = set()
+            for consultant, data in pool.map(write_group, groups.items()):
+                name = f"{INVALID_FILENAME_CHARS.sub('_', str(consultant)) or '未分配'}_{len(groups[consultant])}条"
+                # 不同顾问替换非法字符后可能同名，重名时追加序号，避免 ZIP 中出现重复条目
+                unique_name = name
+                index = 2
+                while unique_name in used_names:
+                    unique_name = f"{name}_{index}"
+                    index += 1
+                used_names.add(unique_name)
+                archive.writestr(f"{unique_name}.{extension}", data)
+        spill.seek(0)
+        return spill.read()
+
+EXPORT_FORMATS = {
+    'xlsx': {'builder': build_excel_export, 'name': "Excel", 'extension': 'xlsx', 'mime': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"},
+    'csv': {'builder': build_csv_export, 'name': "CSV", 'extension': 'csv', 'mime': "text/csv"},
+    'split_xlsx': {'builder': lambda df: build_split_export(df, build_excel_export, 'xlsx'), 'name': "按顾问拆分的Excel", 'extension': 'zip', 'mime': "application/zip"},
+    'split_csv': {'builder': lambda df: build_split_export(df, build_csv_export, 'csv'), 'name': "按顾问拆分的CSV", 'extension': 'zip', 'mime': "application/zip"},
+}
+
+def cached_export(fingerprint, kind):
+    """取已生成的导出文件字节，未生成返回 None"""
+    return st.session_state.export_cache.get((fingerprint, kind))
+
+def export_download_button(df, fingerprint, kind, label, timestamp, button_type="secondary"):
+    """导出文件未生成时显示生成按钮，已生成（或刚生成）时显示下载按钮"""
+    export = EXPORT_FORMATS[kind]
+    data = cached_export(fingerprint, kind)
+    if data is None and st.button(f"⚙️ 生成{export['name']}文件", key=f"generate_{kind}"):
+        with st.spinner(f"正在生成{export['name']}文件..."):
+            data = generate_export(df, fingerprint, kind)
+    if data is not None:
+        st.download_button(
+            label=label,
+            data=data,
+            file_name=f"CRS线索_{timestamp}.{export['extension']}",
+            mime=export['mime'],
+            type=button_type,
+            key=f"download_{kind}"
+        )
+
+def generate_export(df, fingerprint, kind):
+    """生成导出文件并按合并结果指纹缓存；结果变化后旧的导出文件一并丢弃"""
+    trace_memory = st.session_state.trace_export_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        data = EXPORT_FORMATS[kind]['builder'](df)
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    message = f"导出{EXPORT_FORMATS[kind]['name']}: {len(df)} 行，{len(data) / 1024 / 1024:.1f} MB，耗时 {time.perf_counter() - started:.2f} 秒"
+    if peak is not None:
+        message += f"，峰值内存 {peak / 1024 / 1024:.1f} MB"
+    add_log(message)
+    cache = st.session_state.export_cache
+    for key in [key for key in cache if key[0] != fingerprint]:
+        del cache[key]
+    cache[(fingerprint, kind)] = data
+    return data
+
+# 历史号码布隆过滤器：位数组存放在数据库旁的文件中，内存映射读取；参数记在 bloom_meta 表
+BLOOM_PATH = os.path.splitext(LEADS_DB_PATH)[0] + "_phones.bloom"
+BLOOM_MIN_CAPACITY = 1000000
+BLOOM_HASH_KEYS = ("sales-leads-bf-1", "sales-leads-bf-2")   # pd.util.hash_array 要求 16 字节
+BLOOM_REBUILD_BATCH = 500000
+
+def bloom_parameters(capacity, fpr):
+    """按容量和误判率计算位数（按字节取整）和哈希函数个数"""
+    bits = math.ceil(-capacity * math.log(fpr) / math.log(2) ** 2 / 8) * 8
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+def bloom_estimated_fpr(meta):
+    """按当前已存号码数估计实际误判率"""
+    if not meta['items']:
+        return 0.0
+    return (1 - math.exp(-meta['hashes'] * meta['items'] / meta['bits'])) ** meta['hashes']
+
+def bloom_positions(phones, meta):
+    """整列计算每个号码的 k 个位位置（双重哈希）"""
+    values = np.asarray(phones, dtype=object).astype(str).astype(object)
+    h1 = pd.util.hash_array(values, hash_key=BLOOM_HASH_KEYS[0], categorize=False)
+    h2 = pd.util.hash_array(values, hash_key=BLOOM_HASH_KEYS[1], categorize=False) | np.uint64(1)
+    steps = np.arange(meta['hashes'], dtype=np.uint64)
+    return (h1[:, None] + steps * h2[:, None]) % np.uint64(meta['bits'])
+
+def bloom_add(bloom, positions):
+    np.bitwise_or.at(bloom, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+def bloom_contains(bloom, positions):
+    """可能已存在返回 True；返回 False 的号码一定不在历史库中"""
+    return ((bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
+
+def read_bloom_meta(conn):
+    row = conn.execute("SELECT bits, hashes, capacity, items, fpr FROM bloom_meta WHERE id = 1").fetchone()
+    if row is None:
+        return None
+    return dict(zip(['bits', 'hashes', 'capacity', 'items', 'fpr'], row))
+
+def rebuild_phone_bloom(conn, fpr):
+    """从历史库全量重建布隆过滤器（容量留一倍余量，写临时文件后替换）"""
+    started = time.perf_counter()
+    items = conn.execute("SELECT COUNT(*) FROM lead_history").fetchone()[0]
+    capacity = max(BLOOM_MIN_CAPACITY, items * 2)
+    bits, hashes = bloom_parameters(capacity, fpr)
+    meta = {'bits': bits, 'hashes': hashes, 'capacity': capacity, 'items': items, 'fpr': fpr}
+    tmp_path = BLOOM_PATH + ".tmp"
+    bloom = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(bits // 8,))
+    cursor = conn.execute("SELECT phone FROM lead_history")
+    while True:
+        rows = cursor.fetchmany(BLOOM_REBUILD_BATCH)
+        if not rows:
+            break
+        bloom_add(bloom, bloom_positions([row[0] for row in rows], meta))
+    bloom.flush()
+    del bloom
+    os.replace(tmp_path, BLOOM_PATH)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO bloom_meta (id, bits, hashes, capacity, items, fpr) VALUES (1, ?, ?, ?, ?, ?)",
+            (bits, hashes, capacity, items, fpr)
+        )
+    add_log(f"布隆过滤器重建: {items} 个号码，{bits // 8 / 1024 / 1024:.1f} MB，{hashes} 个哈希（{time.perf_counter() - started:.2f} 秒）")
+    return meta
+
+def load_phone_bloom(conn, writable=False):
+    """按需重建并内存映射布隆过滤器，返回 (参数, 位数组)；映射按文件缓存在会话中，重建后自动重新映射"""
+    fpr = float(st.session_state.bloom_fpr)
+    meta = read_bloom_meta(conn)
+    if (meta is None or meta['fpr'] != fpr or not os.path.exists(BLOOM_PATH)
+            or os.path.getsize(BLOOM_PATH) != meta['bits'] // 8):
+        meta = rebuild_phone_bloom(conn, fpr)
+    stat = os.stat(BLOOM_PATH)
+    key = (stat.st_ino, stat.st_size, 'r+' if writable else 'r')
+    cached = st.session_state.get('phone_bloom')
+    if cached is None or cached[0] != key:
+        cached = (key, np.memmap(BLOOM_PATH, dtype=np.uint8, mode=key[2]))
+        st.session_state.phone_bloom = cached
+    return meta, cached[1]
+
+# 增量合并水位：有创建时间列时记录最大创建时间，否则记录上次上传全部行的哈希
+def read_source_watermarks():
+    """读取各来源的水位：{来源: {'source', 'kind', 'max_ts', 'rows', 'has_hashes'}}；已处理行的哈希在 watermark_rows 表中"""
+    with closing(open_leads_db()) as conn, conn:
+        rows = conn.execute("SELECT source, kind, max_ts, row_hashes, rows FROM source_watermarks").fetchall()
+        watermarks = {}
+        for source, kind, max_ts, row_hashes, count in rows:
+            if row_hashes:
+                # 旧版把行哈希整块存在水位行里，迁移到按主键索引的表中
+                save_row_hashes(conn, source, np.frombuffer(row_hashes, dtype=np.uint64))
+                conn.execute("UPDATE source_watermarks SET row_hashes = NULL WHERE source = ?", (source,))
+            watermarks[source] = {
+                'source': source,
+                'kind': kind,
+                'max_ts': pd.Timestamp(max_ts) if max_ts else None,
+                'rows': count,
+                'has_hashes': conn.execute("SELECT 1 FROM watermark_rows WHERE source = ? LIMIT 1", (source,)).fetchone() is not None
+            }
+    return watermarks
+
+def save_row_hashes(conn, source, hashes):
+    """把已处理行的哈希加入 watermark_rows（SQLite 整数为有符号 64 位，按 int64 存储）"""
+    conn.executemany(
+        "INSERT OR IGNORE INTO watermark_rows (source, row_hash) VALUES (?, ?)",
+        ((source, int(h)) for h in np.sort(np.asarray(hashes, dtype=np.uint64).view(np.int64)))   # 按主键顺序插入最快
+    )
+
+def find_processed_rows(source, hashes):
+    """逐行判断哈希是否已处理过：写入临时表后按主键连接，只涉及本次上传的行"""
+    hashes = np.asarray(hashes, dtype=np.uint64).view(np.int64)
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=bool)
+    with closing(open_leads_db()) as conn:
+        conn.execute("CREATE TEMP TABLE incoming_rows (row_hash INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO incoming_rows (row_hash) VALUES (?)", ((int(h),) for h in np.unique(hashes)))
+        known = conn.execute(
+            "SELECT row_hash FROM incoming_rows JOIN watermark_rows USING (row_hash) WHERE source = ?", (source,)
+        ).fetchall()
+    return np.isin(hashes, np.fromiter((row[0] for row in known), dtype=np.int64, count=len(known)))
+
+def save_source_watermarks(conn, watermarks, now):
+    """在台账事务中保存本次合并的水位（整行替换，每个来源一行），并追加本次新行的哈希"""
+    conn.executemany(
+        "INSERT OR REPLACE INTO source_watermarks (source, kind, max_ts, row_hashes, rows, updated_at) VALUES (?, ?, ?, NULL, ?, ?)",
+        [
+            (source, mark['kind'], mark['max_ts'].isoformat() if mark['max_ts'] is not None else None, mark['rows'], now)
+            for source, mark in watermarks.items()
+        ]
+    )
+    for source, mark in watermarks.items():
+        save_row_hashes(conn, source, mark['hashes'])
+
+def clear_source_watermarks():
+    with closing(open_leads_db()) as conn, conn:
+        conn.execute("DELETE FROM source_watermarks")
+        conn.execute("DELETE FROM watermark_rows")
+
+def find_timestamp_column(df):
+    for col in df.columns:
+        if str(col).strip() in SOURCE_TIMESTAMP_CANDIDATES:
+            return col
+    return None
+
+def stable_row_hashes(df):
+    """逐行哈希；按列名排序并统一数字格式，使整块读取和分块读取（全部按字符串）得到相同的哈希"""
+    columns = {}
+    for col in sorted(df.columns, key=str):
+        values = df[col]
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            values = values.astype('Int64')
+        columns[str(col)] = values.astype(str).astype(object).where(values.notna(), '')
+    return pd.util.hash_pandas_object(pd.DataFrame(columns, index=df.index), index=False).to_numpy()
+
+def filter_new_rows(df, watermark, tracker):
+    """按水位跳过已处理的行，同时把本块计入本次上传的新水位（tracker 只记录保留下来的新行的哈希）
+
+    按创建时间时晚于水位的行一定是新行；其余的行（与水位同一时刻、补录的迟到行、创建时间缺失的行）
+    再按已处理行的哈希判断，不在哈希表里的一律保留。
+    """
+    tracker['rows'] += len(df)
+    ts_col = find_timestamp_column(df)
+    hashes = stable_row_hashes(df)
+    seen = None
+    if ts_col is not None:
+        timestamps = pd.to_datetime(df[ts_col], errors='coerce')
+        chunk_max = timestamps.max()
+        tracker['kind'] = 'timestamp'
+        if pd.notna(chunk_max) and (tracker['max_ts'] is None or chunk_max > tracker['max_ts']):
+            tracker['max_ts'] = chunk_max
+        if watermark is not None and watermark['kind'] == 'timestamp' and watermark['max_ts'] is not None:
+            if watermark['has_hashes']:
+                candidates = ~(timestamps > watermark['max_ts']).to_numpy()
+                seen = np.zeros(len(df), dtype=bool)
+                seen[candidates] = find_processed_rows(watermark['source'], hashes[candidates])
+            else:
+                # 旧版水位没有行哈希：只跳过严格早于水位的行，同一时刻和创建时间缺失的行保留
+                seen = (timestamps < watermark['max_ts']).to_numpy()
+    else:
+        tracker['kind'] = 'rows'
+        if watermark is not None and watermark['kind'] == 'rows':
+            seen = find_processed_rows(watermark['source'], hashes)
+    if seen is not None:
+        df = df[~seen]
+        hashes = hashes[~seen]
+    tracker['hashes'].append(hashes)
+    tracker['kept'] += len(df)
+    return df
+
+def new_watermark_tracker():
+    return {'kind': None, 'max_ts': None, 'hashes': [], 'rows': 0, 'kept': 0}
+
+def finish_watermark(tracker, previous):
+    """由本次上传的统计得到新水位；按时间时不回退。hashes 只含本次新行，记入台账时追加到 watermark_rows"""
+    hashes = np.unique(np.concatenate(tracker['hashes'])) if tracker['hashes'] else np.empty(0, dtype=np.uint64)
+    if tracker['kind'] == 'timestamp':
+        max_ts = tracker['max_ts']
+        if previous is not None and previous['kind'] == 'timestamp' and previous['max_ts'] is not None:
+            max_ts = previous['max_ts'] if max_ts is None else max(max_ts, previous['max_ts'])
+        return {'kind': 'timestamp', 'max_ts': max_ts, 'hashes': hashes, 'rows': tracker['rows']}
+    return {'kind': 'rows', 'max_ts': None, 'hashes': hashes, 'rows': tracker['rows']}
+
+def read_allocation_ledger(consultant_names):
+    """读取指定顾问的累计分配数（主键查询，只涉及 m 行）"""
+    ledger = {name: 0 for name in consultant_names}
+    if not consultant_names:
+        return ledger
+    placeholders = ",".join("?" * len(consultant_names))
+    with closing(open_leads_db()) as conn:
+        rows = conn.execute(
+            f"SELECT consultant, total FROM allocation_ledger WHERE consultant IN ({placeholders})",
+            list(consultant_names)
+        ).fetchall()
+    ledger.update(rows)
+    return ledger
+
+def record_allocation(df, run_key, watermarks=None):
+    """把一次合并结果的分配数累加进台账，把手机号写入历史库并保存增量水位；同一结果只记一次，返回是否新记入"""
+    counts = category_counts(df['销售顾问'])
+    counts = counts[counts.index != '']
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with closing(open_leads_db()) as conn, conn:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO allocation_runs (run_key, leads, created_at) VALUES (?, ?, ?)",
+            (run_key, len(df), now)
+        ).rowcount
+        if not inserted:
+            return False
+        conn.executemany(
+            """INSERT INTO allocation_ledger (consultant, total, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(consultant) DO UPDATE SET total = total + excluded.total, updated_at = excluded.updated_at""",
+            [(str(consultant), int(count), now) for consultant, count in counts.items()]
+        )
+        # 已有号码保留首次导出的顾问和日期
+        changes_before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO lead_history (phone, consultant, exported_at) VALUES (?, ?, ?)",
+            zip(df['手机号'].astype(str), df['销售顾问'].astype(str), itertools.repeat(now))
+        )
+        new_phones = conn.total_changes - changes_before
+        if watermarks:
+            save_source_watermarks(conn, watermarks, now)
+        # 提交前先把号码加入布隆过滤器（多置位无害，保证过滤器始终覆盖历史库）；超出容量时下次查询全量重建
+        meta = read_bloom_meta(conn)
+        if (meta is not None and meta['fpr'] == float(st.session_state.bloom_fpr) and os.path.exists(BLOOM_PATH)
+                and meta['items'] + new_phones <= meta['capacity']):
+            meta, bloom = load_phone_bloom(conn, writable=True)
+            bloom_add(bloom, bloom_positions(df['手机号'], meta))
+            bloom.flush()
+            conn.execute("UPDATE bloom_meta SET items = items + ? WHERE id = 1", (new_phones,))
+        else:
+            conn.execute("DELETE FROM bloom_meta")
+    return True
+
+def find_exported_phones(phones):
+    """批量查出已在历史库中的手机号：写入临时表后按主键连接，不逐条查询"""
+    phones = pd.unique(np.asarray(phones, dtype=object))
+    if len(phones) == 0:
+        return set()
+    with closing(open_leads_db()) as conn:
+        # 布隆过滤器判定一定是新号码的直接跳过，只有可能命中的号码做精确查询
+        meta, bloom = load_phone_bloom(conn)
+        maybe = bloom_contains(bloom, bloom_positions(phones, meta))
+        add_log(
+            f"布隆过滤: {len(phones)} 个号码中 {int(maybe.sum())} 个需精确查询"
+            f"（设定误判率 {meta['fpr']:.2%}，当前估计 {bloom_estimated_fpr(meta):.3%}）"
+        )
+        phones = phones[maybe]
+        if len(phones) == 0:
+            return set()
+        conn.execute("CREATE TEMP TABLE incoming_phones (phone TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.executemany("INSERT OR IGNORE INTO incoming_phones (phone) VALUES (?)", ((str(p),) for p in phones))
+        rows = conn.execute("SELECT phone FROM incoming_phones JOIN lead_history USING (phone)").fetchall()
+    return {row[0] for row in rows}
+
+def is_allocation_recorded(run_key):
+    """该合并结果是否已记入台账"""
+    with closing(open_leads_db()) as conn:
+        return conn.execute("SELECT 1 FROM allocation_runs WHERE run_key = ?", (run_key,)).fetchone() is not None
+
+def allocation_run(df):
+    """当前合并结果的台账 run_key（手机号/销售顾问指纹）和是否已记入；同一个结果对象只计算、查询一次"""
+    cached = st.session_state.allocation_run
+    if cached is not None and cached[0] is df:
+        return cached[1]
+    run_key = dataframe_fingerprint(df[['手机号', '销售顾问']])
+    run = {'key': run_key, 'recorded': is_allocation_recorded(run_key)}
+    st.session_state.allocation_run = (df, run)
+    return run
+
+def build_consultant_unit_index():
+    """顾问姓名 -> 单位 的索引（同名取第一条设置，与 get_consultant_unit 一致）"""
+    unit_index = {}
+    for consultant in st.session_state.consultant_settings:
+        unit_index.setdefault(consultant["姓名"], consultant["单位"])
+    return unit_index
+
+def fair_allocate_consultants(leads, selected_consultants_dict, first_consultant=None, ledger_counts=None, seed=None):
+    """公平分配销售顾问（整列生成分配结果，写入线索批次的销售顾问/单位列）
+
+    未提供台账时剩余线索随机分配（seed 非空时使用独立的随机数生成器，结果可复现）；提供 ledger_counts（顾问 -> 累计分配数）时，
+    轮询起点（未指定第一条顾问时）和剩余线索都分给累计最少的顾问，累计数相同的顾问之间随机（同样受 seed 控制）。
+    """
     available_consultants = [name for name, selected in selected_consultants_dict.items() if selected]
     if not available_consultants:
-        return records
+        return leads
     
-    n = len(records)
+    n = lead_count(leads)
     m = len(available_consultants)
     
     # 确定顾问队列顺序（考虑 first_consultant）
@@ -616,95 +1805,148 @@ def fair_allocate_consultants(records, selected_consultants_dict, first_consulta
     else:
         consultant_queue = available_consultants.copy()
     
+    rng = random.Random(seed) if seed else random
+    if ledger_counts is not None:
+        # 累计数相同的顾问随机排序（seed 非空时可复现），台账未更新时余数也不会总落在队列前面的顾问
+        tiebreak = {name: rng.random() for name in consultant_queue}
+        behind = sorted(range(m), key=lambda i: (ledger_counts.get(consultant_queue[i], 0), tiebreak[consultant_queue[i]]))
+        if not (first_consultant and first_consultant in available_consultants):
+            consultant_queue = consultant_queue[behind[0]:] + consultant_queue[:behind[0]]
+            behind = sorted(range(m), key=lambda i: (ledger_counts.get(consultant_queue[i], 0), tiebreak[consultant_queue[i]]))
+    
     # 基础轮询数量
     base_per_consultant = n // m
     remainder = n % m
     
-    # 初始化计数器（仅用于记录，不影响分配）
-    consultant_counts = {c: 0 for c in available_consultants}
-    
-    # 分配基础部分（轮询）
-    for i in range(base_per_consultant * m):
-        consultant = consultant_queue[i % m]
-        records[i]['销售顾问'] = consultant
-        records[i]['单位'] = get_consultant_unit(consultant)
-        consultant_counts[consultant] += 1
-    
-    # 分配剩余部分（随机选取 remainder 个不同的顾问）
-    if remainder > 0:
-        remaining_consultants = random.sample(consultant_queue, remainder)
-        for i in range(remainder):
-            idx = base_per_consultant * m + i
-            consultant = remaining_consultants[i]
-            records[idx]['销售顾问'] = consultant
-            records[idx]['单位'] = get_consultant_unit(consultant)
-            consultant_counts[consultant] += 1
-    
-    return records
-
-def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consultant):
-    """处理合并逻辑 - 汽车之家来源固定为垂媒/汽车之家"""
-    results = []
+    # 每条线索分配到的队列位置：基础部分按队列轮询，剩余部分随机选取 remainder 个不同的顾问
+    positions = np.empty(n, dtype=np.intp)
+    positions[:base_per_consultant * m] = np.tile(np.arange(m), base_per_consultant)
+    if remainder > 0 and ledger_counts is not None:
+        positions[base_per_consultant * m:] = behind[:remainder]
+        add_log(f"分配台账: 余数 {remainder} 条分给累计较少的 {', '.join(consultant_queue[i] for i in behind[:remainder])}")
+    elif remainder > 0:
+        positions[base_per_consultant * m:] = rng.sample(range(m), remainder)
+    
+    unit_index = build_consultant_unit_index()
+    queue = np.array(consultant_queue, dtype=object)
+    units = np.array([unit_index.get(consultant, "") for consultant in consultant_queue], dtype=object)
+    leads['销售顾问'] = queue[positions]
+    leads['单位'] = units[positions]
+    
+    return leads
+
+def process_yiche_chunk(df_yiche, car_matcher, category_index, detail_index, memos, stats):
+    """处理一块易车网数据：清洗姓名/手机、车系与来源映射、排除，返回 (输出列, 排除条数)"""
+    # 可选：打印列名供调试
+    # st.write("易车网文件列名：", list(df_yiche.columns))
+    stats['rows'] += len(df_yiche)
+    stats['chunks'] += 1
+    names = remove_after_slash_column(get_column(df_yiche, '客户姓名'))
+    phones, mobile = normalize_phone_column(get_column(df_yiche, '客户手机'))
+    valid = ((names != '') & (phones != '')).to_numpy()
+    df_valid = df_yiche[valid]
+    names = names[valid]
+    phones = phones[valid]
+    stats['mapped_rows'] += len(df_valid)
+    stats['invalid_phones'] += int((~mobile[valid]).sum())
+    
+    # 尝试多个可能的车系列名（适配新旧格式），取第一个非空值
+    car_series_candidates = ['车系', '意向车系']
+    original_car_series = pd.Series('', index=df_valid.index, dtype=object)
+    found = np.zeros(len(df_valid), dtype=bool)
+    for col in car_series_candidates:
+        if col in df_valid.columns:
+            val = df_valid[col]
+            usable = (val.notna() & (val != '')).to_numpy(dtype=bool) & ~found
+            original_car_series = original_car_series.mask(usable, val.astype(object))
+            found |= usable
+    car_codes, car_uniques = factorize_column(original_car_series)
+    car_series = map_by_codes(
+        car_codes, car_uniques,
+        lambda value: normalize_car_series(value, default_value="昂科威PLUS", original_source="易车网", matcher=car_matcher),
+        memos['car']
+    )
+    car_keys = memo_keys(car_uniques)[car_codes]
+    count_values(memos['counts']['car'], car_uniques, car_codes)
+    
+    # 来源信息：优先使用“BMD二级渠道”（旧格式），若为空则尝试“二级渠道”（新格式）
+    source = get_column(df_valid, 'BMD二级渠道').astype(object)
+    source_missing = (source.isna() | (source == '')).to_numpy(dtype=bool)
+    source = source.mask(source_missing, get_column(df_valid, '二级渠道').astype(object))
+    
+    source_codes, source_uniques = factorize_column(source)
+    source_category = map_by_codes(
+        source_codes, source_uniques, lambda value: map_source_category(value, index=category_index), memos['source_category']
+    )
+    source_detail = map_by_codes(
+        source_codes, source_uniques, lambda value: map_source_detail(value, index=detail_index), memos['source_detail']
+    )
+    source_keys = memo_keys(source_uniques)[source_codes]
+    count_values(memos['counts']['source'], source_uniques, source_codes)
+    
+    # 检查是否需要排除
+    excluded = (source_category == "排除") | (source_detail == "排除")
+    kept = ~excluded
+    
+    columns = build_lead_columns(
+        names[kept], phones[kept], source_category[kept], source_detail[kept], car_series[kept]
+    )
+    # 映射前的原值，供规则修改后增量重映射
+    columns['_车系原值'] = car_keys[kept]
+    columns['_来源原值'] = source_keys[kept]
+    return columns, int(excluded.sum())
+
+def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consultant, ledger_counts=None, skip_exported=False, incremental=False, allocation_seed=None):
+    """处理合并逻辑 - 汽车之家来源固定为垂媒/汽车之家
+
+    incremental=True 时按各来源的水位跳过已处理的行，新水位放在 st.session_state.pending_watermarks，
+    记入分配台账时保存。
+    """
+    parts = []
     excluded_count = 0
+    invalid_phones = 0
+    car_matcher = get_car_series_matcher()
+    category_index = get_source_index("source_category_mapping", "目标分类")
+    detail_index = get_source_index("source_detail_mapping", "目标线索来源")
+    watermarks = read_source_watermarks() if incremental else {}
+    trackers = {}
+    memos = {'car': {}, 'source_category': {}, 'source_detail': {}, 'counts': {'car': defaultdict(int), 'source': defaultdict(int)}}
     
-    # 处理易车网数据（适配新旧两种格式）
+    # 处理易车网数据（适配新旧两种格式）；df_yiche 可以是 DataFrame，也可以是分块读取的迭代器
     if df_yiche is not None:
-        st.info(f"处理易车网数据: {len(df_yiche)} 条记录")
-        # 可选：打印列名供调试
-        # st.write("易车网文件列名：", list(df_yiche.columns))
-        for idx, row in df_yiche.iterrows():
-            name = remove_after_slash(row.get('客户姓名', ''))
-            phone = remove_after_slash(row.get('客户手机', ''))
-        
-            if pd.isna(name) or pd.isna(phone) or name == '' or phone == '':
-                continue
-        
-            # 尝试多个可能的车系列名（适配新旧格式）
-            car_series_candidates = ['车系', '意向车系']
-            original_car_series = ''
-            for col in car_series_candidates:
-                val = row.get(col, '')
-                if pd.notna(val) and val != '':
-                    original_car_series = val
-                    break
-            car_series = normalize_car_series(original_car_series, default_value="昂科威PLUS", original_source="易车网")
-        
-            # 来源信息：优先使用“BMD二级渠道”（旧格式），若为空则尝试“二级渠道”（新格式）
-            source = row.get('BMD二级渠道', '')
-            if pd.isna(source) or source == '':
-                source = row.get('二级渠道', '')
-        
-            source_category = map_source_category(source)
-            source_detail = map_source_detail(source)
-        
-            # 检查是否需要排除
-            if source_category == "排除" or source_detail == "排除":
-                excluded_count += 1
-                continue
-            
-            results.append({
-                '姓名': name,
-                '手机号': phone,
-                '性别': '',
-                '来源分类': source_category,
-                '线索来源': source_detail,
-                '备注': '',
-                '意向品牌': '别克',
-                '意向车系': car_series,
-                '销售顾问': '',
-                '单位': '',
-                '跟进内容': ''
-            })
+        streaming = not isinstance(df_yiche, pd.DataFrame)
+        if not streaming:
+            st.info(f"处理易车网数据: {len(df_yiche)} 条记录")
+        chunks = df_yiche if streaming else [df_yiche]
+        stats = {'rows': 0, 'mapped_rows': 0, 'chunks': 0, 'invalid_phones': 0}
+        if incremental:
+            trackers['易车网'] = new_watermark_tracker()
+        for chunk in chunks:
+            if incremental:
+                chunk = filter_new_rows(chunk, watermarks.get('易车网'), trackers['易车网'])
+            chunk_columns, chunk_excluded = process_yiche_chunk(chunk, car_matcher, category_index, detail_index, memos, stats)
+            parts.append(chunk_columns)
+            excluded_count += chunk_excluded
+        if streaming:
+            st.info(f"处理易车网数据: {stats['rows']} 条记录（分 {stats['chunks']} 块流式处理）")
+        add_log(
+            f"易车网唯一值映射: 车系 {len(memos['car'])} 个不同值 / {stats['mapped_rows']} 行，"
+            f"来源 {len(memos['source_category'])} 个不同值 / {stats['mapped_rows']} 行"
+        )
+        invalid_phones += stats['invalid_phones']
     
     # 处理汽车之家数据
     if df_autohome is not None:
         st.info(f"处理汽车之家数据: {len(df_autohome)} 条记录")
+        if incremental:
+            trackers['汽车之家'] = new_watermark_tracker()
+            df_autohome = filter_new_rows(df_autohome, watermarks.get('汽车之家'), trackers['汽车之家'])
 
         # 获取实际列名（去除两端空格）
         actual_cols = [str(col).strip() for col in df_autohome.columns]
 
         # 候选列名（去除空格后）
-        candidates = ['意向车系车型', '意向车系', '车系', '线索意向车型车系', '车型']
+        candidates = AUTOHOME_CAR_SERIES_CANDIDATES
         # 构建实际列名到候选的映射（忽略空格）
         col_map = {}
         for actual in actual_cols:
@@ -726,67 +1968,86 @@ def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consul
         else:
             st.info(f"使用列名: '{target_col}' 作为车系来源")
 
-        for idx, row in df_autohome.iterrows():
-            name = remove_after_slash(row.get('客户姓名', ''))
-            phone = remove_after_slash(row.get('客户号码', ''))
-            
-            if pd.isna(name) or pd.isna(phone) or name == '' or phone == '':
-                continue
-            
-            # 获取车系
-            if target_col:
-                original_car_series = row.get(target_col, '')
-            else:
-                original_car_series = ''
+        names = remove_after_slash_column(get_column(df_autohome, '客户姓名'))
+        phones, mobile = normalize_phone_column(get_column(df_autohome, '客户号码'))
+        valid = ((names != '') & (phones != '')).to_numpy()
+        df_valid = df_autohome[valid]
+        invalid_phones += int((~mobile[valid]).sum())
         
-            car_series = normalize_car_series(original_car_series, default_value="昂科威PLUS", original_source="汽车之家")
-            
-            # 来源信息 - 固定为垂媒和汽车之家（不再从文件中读取）
-            source_category = "垂媒"
-            source_detail = "汽车之家"
-            
-            results.append({
-                '姓名': name,
-                '手机号': phone,
-                '性别': '',
-                '来源分类': source_category,
-                '线索来源': source_detail,
-                '备注': '',
-                '意向品牌': '别克',
-                '意向车系': car_series,
-                '销售顾问': '',
-                '单位': '',
-                '跟进内容': ''
-            })
+        # 获取车系
+        if target_col:
+            original_car_series = get_column(df_valid, target_col).astype(object)
+        else:
+            original_car_series = pd.Series('', index=df_valid.index, dtype=object)
+        car_codes, car_uniques = factorize_column(original_car_series)
+        car_series = map_by_codes(
+            car_codes, car_uniques,
+            lambda value: normalize_car_series(value, default_value="昂科威PLUS", original_source="汽车之家", matcher=car_matcher),
+            memos['car']
+        )
+        count_values(memos['counts']['car'], car_uniques, car_codes)
+        add_log(f"汽车之家唯一值映射: 车系 {len(car_uniques)} 个不同值 / {len(car_codes)} 行")
+        
+        # 来源信息 - 固定为垂媒和汽车之家（不再从文件中读取）
+        columns = build_lead_columns(names[valid], phones[valid], "垂媒", "汽车之家", car_series)
+        columns['_车系原值'] = memo_keys(car_uniques)[car_codes]
+        columns['_来源原值'] = None   # 来源固定，不参与重映射
+        parts.append(columns)
+    
+    # 增量合并：记录跳过的行数和新水位
+    if incremental:
+        pending = {}
+        for source, tracker in trackers.items():
+            previous = watermarks.get(source)
+            pending[source] = finish_watermark(tracker, previous)
+            if previous is None:
+                add_log(f"增量合并: {source} 尚无水位，本次处理全部 {tracker['rows']} 行")
+            else:
+                basis = "创建时间" if previous['kind'] == 'timestamp' else "上次上传的行哈希"
+                add_log(f"增量合并: {source} 按{basis}跳过 {tracker['rows'] - tracker['kept']} 行已处理数据，新增 {tracker['kept']} 行")
+        st.session_state.pending_watermarks = pending
+    else:
+        st.session_state.pending_watermarks = {}
     
     # 合并结果
     if excluded_count > 0:
         add_log(f"排除了 {excluded_count} 条被标记为'排除'的线索")
+    if invalid_phones > 0:
+        add_log(f"手机号规范化: {invalid_phones} 条线索的号码不是有效的11位手机号（保留原值）")
     
-    if not results:
+    total = sum(len(part['姓名']) for part in parts)
+    if total == 0 and incremental:
+        st.info("没有新增线索：上传文件中的行都已处理过")
+        return None
+    if total == 0:
         st.error("没有找到有效数据")
         return None
     
-    df = pd.DataFrame(results)
+    # 各列以数组/标量形式完成去重、筛选和分配，最后只物化一次 DataFrame
+    leads = concat_lead_batches(parts)
     
     # 去重
-    before_dedup = len(df)
-    df = df.drop_duplicates(subset=['手机号'], keep='first')
-    after_dedup = len(df)
+    before_dedup = lead_count(leads)
+    leads = take_leads(leads, ~pd.Series(leads['手机号'], dtype=object).duplicated(keep='first').to_numpy())
+    after_dedup = lead_count(leads)
     
     add_log(f"去重: {before_dedup} -> {after_dedup} 条记录")
     
-    # 检查并修复空车系
-    empty_car_series_count = df['意向车系'].isna().sum() + (df['意向车系'] == '').sum()
-    if empty_car_series_count > 0:
-        df['意向车系'] = df['意向车系'].apply(lambda x: "昂科威PLUS" if pd.isna(x) or str(x).strip() == '' else x)
+    # 历史去重：排除已导出过的手机号
+    if skip_exported:
+        exported = find_exported_phones(pd.Series(leads['手机号'], dtype=object))
+        if exported:
+            leads = take_leads(leads, ~pd.Series(leads['手机号'], dtype=object).isin(exported).to_numpy())
+        add_log(f"历史去重: 排除 {len(exported)} 条已导出的号码，剩余 {lead_count(leads)} 条")
     
-    # 公平分配销售顾问
-    records = df.to_dict('records')
-    records = fair_allocate_consultants(records, selected_consultants_dict, first_consultant)
+    # 检查并修复空车系（按不同值判断，避免逐行 apply）
+    car_codes, car_values = pd.factorize(lead_column(leads, '意向车系'), use_na_sentinel=False)
+    blank_values = np.array([pd.isna(value) or str(value).strip() == '' for value in car_values], dtype=bool)
+    if any(pd.isna(value) or value == '' for value in car_values):
+        leads['意向车系'] = np.where(blank_values[car_codes], "昂科威PLUS", leads['意向车系'])
     
-    # 转换回DataFrame
-    df = pd.DataFrame(records)
+    # 公平分配销售顾问
+    leads = fair_allocate_consultants(leads, selected_consultants_dict, first_consultant, ledger_counts, allocation_seed)
     
     # 确保数据列的顺序
     final_columns = [
@@ -794,11 +2055,357 @@ def process_merge(df_yiche, df_autohome, selected_consultants_dict, first_consul
         '意向品牌', '意向车系', '销售顾问', '单位', '跟进内容'
     ]
     
+    # 保留原值编码和映射表，规则修改后只重映射受影响的不同值
+    st.session_state.merge_state = build_merge_state(lead_column(leads, '_车系原值'), lead_column(leads, '_来源原值'), memos)
+    
     # 确保DataFrame只包含我们需要的列
-    df = df[final_columns]
+    df = leads_to_frame(leads, final_columns, output_categories())
+    
+    return df
+
+# 规则修改后的增量重映射
+REMAP_RULES = {
+    'car': ('car_series_mapping', "原始模式", "目标车系"),
+    'source_category': ('source_category_mapping', "原始来源", "目标分类"),
+    'source_detail': ('source_detail_mapping', "原始来源", "目标线索来源"),
+}
+
+def enabled_rule_pairs(kind):
+    mapping_name, pattern_field, target_field = REMAP_RULES[kind]
+    return [
+        (rule[pattern_field], rule[target_field])
+        for rule in st.session_state[mapping_name]
+        if rule["是否启用"] and isinstance(rule[pattern_field], str)
+    ]
+
+def build_merge_state(car_keys, source_keys, memos):
+    """合并结果每行的车系/来源原值编码（autohome 行来源编码为 -1）+ 唯一值映射表 + 生成时的规则"""
+    car_codes, car_values = pd.factorize(np.asarray(car_keys, dtype=object), use_na_sentinel=False)
+    source_codes, source_values = pd.factorize(np.asarray(source_keys, dtype=object))
+    return {
+        'rules': {kind: enabled_rule_pairs(kind) for kind in REMAP_RULES},
+        'maps': {kind: dict(memos[kind]) for kind in REMAP_RULES},
+        'counts': {kind: dict(counts) for kind, counts in memos['counts'].items()},   # 每个原值参与映射的行数
+        'car_values': [value if isinstance(value, str) else None for value in car_values],
+        'car_codes': car_codes,
+        'source_values': list(source_values),
+        'source_codes': source_codes,
+    }
+
+def changed_rule_pairs(old_pairs, new_pairs):
+    """新旧规则列表中被修改、删除、新增或移动的规则；其余规则相对顺序不变"""
+    changed = []
+    matcher = difflib.SequenceMatcher(None, old_pairs, new_pairs, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            changed.extend(old_pairs[i1:i2])
+            changed.extend(new_pairs[j1:j2])
+    return changed
+
+def affected_values(kind, values, changed):
+    """只命中未变化规则的值，其首个命中规则新旧相同，结果不变；返回可能变化的值"""
+    if kind == 'car':
+        segments = compile_car_series_rules([
+            {"原始模式": pattern, "目标车系": target, "是否启用": True} for pattern, target in changed
+        ])
+        return [value for value in values if value is not None and value.strip() != ''
+                and match_car_series(segments, value.strip())[0]]
+    index = build_source_index([{"原始来源": pattern, "目标": target, "是否启用": True} for pattern, target in changed], "目标")
+    return [value for value in values if value is not None and value.strip() != ''
+            and lookup_source_index(index, value.strip())[0]]
+
+def refresh_merged_result():
+    """规则保存后增量更新合并结果：只重算受影响的不同值并按编码回填列；排除集合变化时提示重新合并"""
+    state = st.session_state.merge_state
+    if state is None or st.session_state.df_merged is None:
+        return
+    current = {kind: enabled_rule_pairs(kind) for kind in REMAP_RULES}
+    changed_kinds = [kind for kind in REMAP_RULES if current[kind] != state['rules'][kind]]
+    if not changed_kinds:
+        return
+    
+    started = time.perf_counter()
+    # 匹配器和来源索引每类只取一次，逐值匹配时不再重复查找
+    matchers = {}
+    if 'car' in changed_kinds:
+        car_matcher = get_car_series_matcher()
+        matchers['car'] = lambda value: normalize_car_series(value, default_value="昂科威PLUS", matcher=car_matcher)
+    if 'source_category' in changed_kinds:
+        category_index = get_source_index("source_category_mapping", "目标分类")
+        matchers['source_category'] = lambda value: map_source_category(value, index=category_index)
+    if 'source_detail' in changed_kinds:
+        detail_index = get_source_index("source_detail_mapping", "目标线索来源")
+        matchers['source_detail'] = lambda value: map_source_detail(value, index=detail_index)
+    updates = {}
+    for kind in changed_kinds:
+        changed = changed_rule_pairs(state['rules'][kind], current[kind])
+        candidates = affected_values(kind, state['maps'][kind].keys(), changed)
+        updates[kind] = {value: matchers[kind](value) for value in candidates}
+        updates[kind] = {value: target for value, target in updates[kind].items() if target != state['maps'][kind][value]}
     
+    # 排除集合变化时，去重和分配都要重做
+    maps = state['maps']
+    for value in set(updates.get('source_category', {})) | set(updates.get('source_detail', {})):
+        old_excluded = "排除" in (maps['source_category'][value], maps['source_detail'][value])
+        new_excluded = "排除" in (updates.get('source_category', {}).get(value, maps['source_category'][value]),
+                                 updates.get('source_detail', {}).get(value, maps['source_detail'][value]))
+        if old_excluded != new_excluded:
+            st.session_state.merge_state = None
+            st.session_state.merge_result_stale = True
+            add_log("规则修改改变了排除的来源，需要重新合并")
+            return
+    
+    df = st.session_state.df_merged.copy()
+    patched_rows = 0
+    for kind, column, values_key, codes_key in (
+        ('car', '意向车系', 'car_values', 'car_codes'),
+        ('source_category', '来源分类', 'source_values', 'source_codes'),
+        ('source_detail', '线索来源', 'source_values', 'source_codes'),
+    ):
+        if not updates.get(kind):
+            continue
+        maps[kind].update(updates[kind])
+        values = state[values_key]
+        changed_codes = [i for i, value in enumerate(values) if value in updates[kind]]
+        targets = np.empty(len(values), dtype=object)
+        targets[:] = [maps[kind][value] for value in values]
+        if kind == 'car':
+            # 与合并时相同：空车系统一为默认值
+            targets[:] = ["昂科威PLUS" if pd.isna(target) or str(target).strip() == '' else target for target in targets]
+        rows = np.isin(state[codes_key], changed_codes)
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            new_categories = [target for target in dict.fromkeys(targets[state[codes_key][rows]]) if target not in df[column].cat.categories]
+            df[column] = df[column].cat.add_categories(new_categories)
+        df.loc[rows, column] = targets[state[codes_key][rows]]
+        patched_rows += int(rows.sum())
+    state['rules'] = current
+    st.session_state.df_merged = df
+    add_log(
+        f"规则修改: 重新映射 {sum(len(update) for update in updates.values())} 个不同值，"
+        f"更新 {patched_rows} 行（{(time.perf_counter() - started) * 1000:.0f} ms）"
+    )
+
+# 上传文件解析（按内容哈希缓存，每个上传只解析一次）
+def cached_parse(uploaded, options, parser):
+    """按 (内容哈希, 解析选项) 缓存解析结果，超过内存上限时按 LRU 淘汰"""
+    cache = st.session_state.upload_cache
+    key = (get_upload_hash(uploaded), options)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key][0]
+    
+    df = parser(uploaded.getvalue())
+    cache[key] = (df, int(df.memory_usage(deep=True).sum()))
+    
+    # 至少保留最近解析的一项
+    limit = st.session_state.upload_cache_max_mb * 1024 * 1024
+    while len(cache) > 1 and sum(size for _, size in cache.values()) > limit:
+        cache.popitem(last=False)
+    return df
+
+def parse_yiche_csv(data):
+    """解析易车网CSV（编码一次检测确定）"""
+    encoding = detect_encoding(data, "易车网CSV")
+    try:
+        return pd.read_csv(io.BytesIO(data), encoding=encoding, usecols=yiche_usecols)
+    except UnicodeDecodeError:
+        add_log(f"易车网CSV 按 {encoding} 解析失败，改为 utf-8 忽略错误字节")
+        return pd.read_csv(io.BytesIO(data), encoding='utf-8', encoding_errors='ignore', usecols=yiche_usecols)
+
+def iter_yiche_chunks(data, chunk_rows):
+    """分块读取易车网CSV，逐块产出 DataFrame
+
+    各列按文本读取，避免不同块的类型推断不一致（例如某块手机号含空值被推断为浮点数）。
+    """
+    encoding = detect_encoding(data, "易车网CSV")
+    with pd.read_csv(io.BytesIO(data), encoding=encoding, encoding_errors='ignore',
+                     usecols=yiche_usecols, dtype=str, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk
+
+def preview_yiche_file(uploaded, rows=5):
+    """流式模式下只读取前几行用于预览（带缓存，页面刷新时不重复读取和检测编码）"""
+    def parse_preview(data):
+        encoding = detect_encoding(data, "易车网CSV预览")
+        return pd.read_csv(io.BytesIO(data), encoding=encoding, encoding_errors='ignore',
+                           usecols=yiche_usecols, dtype=str, nrows=rows)
+    return cached_parse(uploaded, ('yiche_preview', rows), parse_preview)
+
+# Excel 读取引擎：calamine（可选依赖 python-calamine）或 openpyxl 只读流式读取
+EXCEL_ERROR_CODES = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A', '#GETTING_DATA')
+
+def resolve_excel_engine(data):
+    """根据设置与已安装的依赖选择Excel读取引擎"""
+    engine = st.session_state.excel_engine
+    if engine in ("自动", "calamine"):
+        # 依赖不满足时（pandas 低于 2.2 或未安装 python-calamine）回退到 openpyxl
+        engine = "calamine" if calamine_available() else "openpyxl"
+    if engine == "openpyxl" and not data.startswith(b'PK'):
+        engine = "default"   # 旧版 .xls 不是 zip 包，openpyxl 无法读取，交给 pandas 默认引擎
+    return engine
+
+def convert_excel_value(value):
+    """与 pandas openpyxl 读取器一致的单元格转换"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in EXCEL_ERROR_CODES:
+        return np.nan
+    return value
+
+def read_excel_openpyxl_streaming(data, usecols):
+    """openpyxl 只读模式逐行读取，只转换需要的列，再按 pandas 相同的规则推断类型"""
+    from openpyxl import load_workbook
+    from pandas.io.parsers import TextParser
+
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+        header = [convert_excel_value(value) for value in next(rows, ())]
+        keep = [i for i, name in enumerate(header) if usecols(name)]
+        data_rows = [[header[i] for i in keep]]
+        last_row_with_data = 0 if any(value != "" for value in header) else -1
+        for row in rows:
+            width = len(row)
+            data_rows.append([convert_excel_value(row[i]) if i < width else "" for i in keep])
+            # 末尾空行按整行（而不只是所需列）判断，与完整读取一致
+            if row.count(None) + row.count("") < width:
+                last_row_with_data = len(data_rows) - 1
+    finally:
+        workbook.close()
+
+    data_rows = data_rows[:last_row_with_data + 1]
+    if not data_rows:
+        return pd.DataFrame()
+    parser = TextParser(data_rows, header=0, index_col=None, skip_blank_lines=False)
+    return parser.read()
+
+def parse_autohome_excel(data):
+    """解析汽车之家Excel（只读取合并所需列，按设置选择读取引擎）"""
+    engine = resolve_excel_engine(data)
+    start_time = time.perf_counter()
+    if engine == "calamine":
+        df = pd.read_excel(io.BytesIO(data), engine="calamine", usecols=autohome_usecols)
+    elif engine == "openpyxl":
+        df = read_excel_openpyxl_streaming(data, autohome_usecols)
+    else:
+        df = pd.read_excel(io.BytesIO(data), usecols=autohome_usecols)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    add_log(f"汽车之家Excel 读取引擎: {engine}（{elapsed_ms:.1f} ms）")
     return df
 
+def load_yiche_file(uploaded):
+    """读取易车网CSV（带缓存）"""
+    return cached_parse(uploaded, ('yiche_csv', 'usecols'), parse_yiche_csv)
+
+def load_autohome_file(uploaded):
+    """读取汽车之家Excel（带缓存）"""
+    return cached_parse(uploaded, ('autohome_excel', 'usecols', st.session_state.excel_engine), parse_autohome_excel)
+
+# 规则命中分析：按上次合并的唯一值和行数，统计每条规则的命中、评估次数和耗时
+LITERAL_EXACT_PATTERN = re.compile(r'\^([^\\.^$*+?{}\[\]|()]*)\$')
+
+def rule_tester(kind, pattern):
+    """单条规则的匹配函数，与映射引擎的命中条件一致"""
+    if kind != 'car':
+        return lambda value: pattern in value or value in pattern
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        return lambda value: pattern in value or value in pattern
+    return lambda value: compiled.search(value) is not None
+
+def profile_rules(kind):
+    """对上次合并中出现过的每个唯一值逐条规则求值，返回每条规则的统计表"""
+    state = st.session_state.merge_state
+    mapping_name, pattern_field, target_field = REMAP_RULES[kind]
+    counts = state['counts']['car' if kind == 'car' else 'source']
+    values = [(value.strip(), count) for value, count in counts.items() if value is not None and value.strip() != '']
+    total_rows = sum(count for _, count in values)
+    
+    winners = [None] * len(values)
+    rows = []
+    first_seen = {}
+    for position, rule in enumerate(st.session_state[mapping_name]):
+        pattern = rule[pattern_field]
+        if not rule["是否启用"] or not isinstance(pattern, str):
+            continue
+        test = rule_tester(kind, pattern)
+        started = time.perf_counter()
+        matched = [i for i, (value, _) in enumerate(values) if test(value)]
+        elapsed = time.perf_counter() - started
+        # 评估次数：先匹配先生效，只有前面规则都未命中的行才会走到这条规则
+        evaluations = sum(count for i, (_, count) in enumerate(values) if winners[i] is None)
+        won = [i for i in matched if winners[i] is None]
+        for i in won:
+            winners[i] = position
+        if pattern in first_seen:
+            status = f"重复（同 #{first_seen[pattern] + 1}）"
+        elif not matched:
+            status = "未命中"
+        elif not won:
+            shadowing = sorted({winners[i] + 1 for i in matched})
+            status = "被遮蔽（" + "、".join(f"#{k}" for k in shadowing[:3]) + ("…" if len(shadowing) > 3 else "") + "）"
+        else:
+            status = "正常"
+        first_seen.setdefault(pattern, position)
+        rows.append({
+            '序号': position + 1,
+            pattern_field: pattern,
+            target_field: rule[target_field],
+            '命中行数': sum(values[i][1] for i in won),
+            '命中不同值': len(won),
+            '评估次数': evaluations,
+            '单次耗时(µs)': round(elapsed / max(len(values), 1) * 1e6, 2),
+            '状态': status,
+        })
+    stats = pd.DataFrame(rows)
+    if total_rows and not stats.empty:
+        stats['命中占比'] = (stats['命中行数'] / total_rows).map('{:.1%}'.format)
+    return stats
+
+def cached_rule_profile(kind, run=False):
+    """规则命中统计表：run 为 True 时计算，结果按 (合并状态对象, 规则类型, 规则列表) 缓存；没有可用结果时返回 None"""
+    state = st.session_state.merge_state
+    rules = st.session_state[REMAP_RULES[kind][0]]
+    rules_key = hashlib.sha256(json.dumps(rules, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    cached = st.session_state.rule_profile
+    if cached is not None and cached[0] is state and cached[1] == (kind, rules_key):
+        return cached[2]
+    if not run:
+        return None
+    stats = profile_rules(kind)
+    st.session_state.rule_profile = (state, (kind, rules_key), stats)
+    return stats
+
+def rules_commute(first, second):
+    """相邻两条车系规则交换顺序后先匹配先生效的结果是否一定不变"""
+    if not first["是否启用"] or not second["是否启用"]:
+        return True   # 未启用的规则不参与匹配
+    if first["目标车系"] == second["目标车系"]:
+        return True   # 同时命中时结果相同
+    exact_first = LITERAL_EXACT_PATTERN.fullmatch(str(first["原始模式"]))
+    exact_second = LITERAL_EXACT_PATTERN.fullmatch(str(second["原始模式"]))
+    # 两条都是整串精确匹配的不同文本时不可能同时命中
+    return bool(exact_first and exact_second and exact_first.group(1).lower() != exact_second.group(1).lower())
+
+def optimize_car_rule_order(rules, hits):
+    """把命中多的规则前移：只交换可证明可交换的相邻规则（稳定插入排序），返回 (新规则列表, 移动的规则数)"""
+    order = list(range(len(rules)))
+    for i in range(1, len(order)):
+        j = i
+        while j > 0 and hits.get(order[j], 0) > hits.get(order[j - 1], 0) and rules_commute(rules[order[j - 1]], rules[order[j]]):
+            order[j - 1], order[j] = order[j], order[j - 1]
+            j -= 1
+    moved = sum(1 for new_position, old_position in enumerate(order) if new_position != old_position)
+    return [rules[i] for i in order], moved
+
+# 规则修改后，在现有合并结果上增量重映射
+refresh_merged_result()
+
 # 主功能区
 tab1, tab2, tab3 = st.tabs(["📁 数据上传", "⚙️ 数据处理", "📊 结果分析"])
 
@@ -811,26 +2418,19 @@ with tab1:
         st.subheader("易车网文件 (CSV)")
         if yiche_file:
             try:
-                # 尝试多种编码读取CSV
-                try:
-                    df_yiche = pd.read_csv(yiche_file, encoding='utf-8')
-                except:
-                    try:
-                        df_yiche = pd.read_csv(yiche_file, encoding='gbk')
-                    except:
-                        content = yiche_file.getvalue()
-                        try:
-                            content_str = content.decode('utf-8-sig')
-                        except:
-                            content_str = content.decode('utf-8', errors='ignore')
-                        df_yiche = pd.read_csv(io.StringIO(content_str))
-                
-                st.success(f"✅ 成功读取易车网文件，共 {len(df_yiche)} 条记录")
+                if st.session_state.yiche_streaming:
+                    # 流式模式下不整体加载，只预览前几行
+                    df_yiche = preview_yiche_file(yiche_file)
+                    st.success("✅ 已启用分块流式处理，合并时按块读取易车网文件")
+                else:
+                    # 尝试多种编码读取CSV（带缓存）
+                    df_yiche = load_yiche_file(yiche_file)
+                    st.success(f"✅ 成功读取易车网文件，共 {len(df_yiche)} 条记录")
                 st.dataframe(df_yiche.head(), use_container_width=True)
                 
                 # 显示列名
                 with st.expander("查看文件列名"):
-                    st.write("列名列表:", list(df_yiche.columns))
+                    st.write("已读取列（仅加载合并所需列）:", list(df_yiche.columns))
             except Exception as e:
                 st.error(f"读取失败: {str(e)}")
                 st.info("如果文件格式有问题，请尝试使用左侧的'文件格式修复'功能")
@@ -841,13 +2441,13 @@ with tab1:
         st.subheader("汽车之家文件 (Excel)")
         if autohome_file:
             try:
-                df_autohome = pd.read_excel(autohome_file)
+                df_autohome = load_autohome_file(autohome_file)
                 st.success(f"✅ 成功读取汽车之家文件，共 {len(df_autohome)} 条记录")
                 st.dataframe(df_autohome.head(), use_container_width=True)
                 
                 # 显示列名
                 with st.expander("查看文件列名"):
-                    st.write("列名列表:", list(df_autohome.columns))
+                    st.write("已读取列（仅加载合并所需列）:", list(df_autohome.columns))
                     
             except Exception as e:
                 st.error(f"读取失败: {str(e)}")
@@ -882,6 +2482,45 @@ with tab2:
             total_detail = len(st.session_state.source_detail_mapping)
             st.metric("线索来源规则", f"{enabled_detail}/{total_detail} 条启用")
     
+    # 规则命中分析（基于上次合并）
+    if st.session_state.merge_state is not None:
+        with st.expander("📈 规则命中分析", expanded=False):
+            st.caption("基于上次合并中出现的原值统计：评估次数越多、单次耗时越高的规则越值得前移；未命中/被遮蔽/重复的规则可以考虑删除")
+            rule_kind = st.selectbox(
+                "规则类型", list(REMAP_RULES), format_func=lambda kind: {"car": "车系映射", "source_category": "来源分类", "source_detail": "线索来源"}[kind],
+                key="profile_rule_kind"
+            )
+            # 逐条规则求值较慢，只在点击时统计，结果缓存到合并结果或规则变化为止
+            run_profile = st.button("📊 统计规则命中", key="run_rule_profile")
+            rule_stats = cached_rule_profile(rule_kind, run=run_profile)
+            if rule_stats is None:
+                st.caption("点击「统计规则命中」后显示各条规则的统计")
+            else:
+                st.dataframe(rule_stats, use_container_width=True, hide_index=True)
+            if rule_stats is not None and rule_kind == 'car' and not rule_stats.empty:
+                if st.button("⚡ 按命中频率优化车系规则顺序", help="只交换结果可证明不变的相邻规则（目标相同或互斥的精确匹配），不改变任何车系的映射结果"):
+                    hits = {row['序号'] - 1: row['命中行数'] for row in rule_stats.to_dict('records')}
+                    new_rules, moved = optimize_car_rule_order(st.session_state.car_series_mapping, hits)
+                    st.session_state.car_series_mapping = new_rules
+                    get_car_series_matcher()
+                    add_log(f"车系规则顺序优化: 移动 {moved} 条规则")
+                    st.success(f"已调整 {moved} 条规则的位置，映射结果不变")
+    
+    # 增量合并水位
+    if st.session_state.incremental_merge:
+        with st.expander("查看增量合并水位", expanded=False):
+            source_watermarks = read_source_watermarks()
+            if not source_watermarks:
+                st.caption("尚无水位：下一次合并处理全部行，记入分配台账后生效")
+            for source, mark in source_watermarks.items():
+                if mark['kind'] == 'timestamp':
+                    st.write(f"**{source}**: 最大创建时间 {mark['max_ts']}（上次上传 {mark['rows']} 行）")
+                else:
+                    st.write(f"**{source}**: 按已处理行的哈希判断（上次上传 {mark['rows']} 行）")
+            if source_watermarks and st.button("重置水位", key="clear_watermarks"):
+                clear_source_watermarks()
+                st.success("水位已重置，下一次合并将处理全部行")
+    
     # 检查是否有选中的销售顾问
     if not selected_consultants:
         st.warning("⚠️ 请先在侧边栏选择至少一个销售顾问")
@@ -893,65 +2532,90 @@ with tab2:
         if st.button("🚀 开始合并处理", type="primary"):
             with st.spinner("正在处理数据..."):
                 try:
+                    # 相同的文件和配置直接使用上次的合并结果
+                    if st.session_state.fixed_yiche_df is not None:
+                        yiche_key = ['fixed', st.session_state.fixed_yiche_hash]
+                    else:
+                        yiche_key = get_upload_hash(yiche_file) if yiche_file else None
+                    ledger_counts = read_allocation_ledger(selected_consultants) if st.session_state.use_allocation_ledger else None
+                    merge_options = {
+                        'skip_exported': st.session_state.skip_exported_phones,
+                        'incremental': st.session_state.incremental_merge,
+                        # 种子为 0 时使用本会话抽取的种子，缓存键里是实际使用的种子
+                        'seed': int(st.session_state.allocation_seed) or st.session_state.session_allocation_seed,
+                    }
+                    memo_key = merge_memo_key(
+                        [yiche_key, get_upload_hash(autohome_file) if autohome_file else None],
+                        selected_consultants, first_consultant, ledger_counts, merge_options
+                    )
+                    memo = get_merge_memo(memo_key)
+                    
                     # 读取数据
                     df_yiche = None
                     df_autohome = None
                     
-                    # 优先使用修复后的易车网数据
-                    if st.session_state.fixed_yiche_df is not None:
-                        df_yiche = st.session_state.fixed_yiche_df
-                    elif yiche_file:
-                        # 尝试多种编码读取CSV
-                        try:
-                            df_yiche = pd.read_csv(yiche_file, encoding='utf-8')
-                        except:
-                            try:
-                                df_yiche = pd.read_csv(yiche_file, encoding='gbk')
-                            except:
-                                content = yiche_file.getvalue()
-                                try:
-                                    content_str = content.decode('utf-8-sig')
-                                except:
-                                    content_str = content.decode('utf-8', errors='ignore')
-                                df_yiche = pd.read_csv(io.StringIO(content_str))
-                    
-                    # 读取汽车之家Excel
-                    if autohome_file:
-                        df_autohome = pd.read_excel(autohome_file)
+                    if memo is not None:
+                        df_result, st.session_state.pending_watermarks, merge_state = memo
+                        st.session_state.merge_state = copy.deepcopy(merge_state)
+                        add_log("相同的文件和配置已合并过，直接使用缓存的结果")
+                        st.info("⚡ 相同的文件和配置已合并过，直接使用缓存的结果")
+                    else:
+                        # 优先使用修复后的易车网数据
+                        if st.session_state.fixed_yiche_df is not None:
+                            df_yiche = st.session_state.fixed_yiche_df
+                        elif yiche_file and st.session_state.yiche_streaming:
+                            # 大文件按块流式读取
+                            df_yiche = iter_yiche_chunks(yiche_file.getvalue(), int(st.session_state.yiche_chunk_rows))
+                        elif yiche_file:
+                            # 尝试多种编码读取CSV（带缓存）
+                            df_yiche = load_yiche_file(yiche_file)
+                        
+                        # 读取汽车之家Excel
+                        if autohome_file:
+                            df_autohome = load_autohome_file(autohome_file)
+                        
+                        if df_yiche is None and df_autohome is None:
+                            st.error("没有可处理的数据文件")
+                            df_result = None
+                        else:
+                            # 处理合并
+                            df_result = process_merge(
+                                df_yiche, df_autohome, consultants, first_consultant, ledger_counts,
+                                skip_exported=merge_options['skip_exported'],
+                                incremental=merge_options['incremental'],
+                                allocation_seed=merge_options['seed']
+                            )
+                            if df_result is not None:
+                                store_merge_memo(memo_key, df_result, st.session_state.pending_watermarks, copy.deepcopy(st.session_state.merge_state))
                     
-                    # 处理合并
-                    if df_yiche is not None or df_autohome is not None:
-                        df_result = process_merge(df_yiche, df_autohome, consultants, first_consultant)
+                    if df_result is not None:
+                        # 保存到session state
+                        st.session_state.df_merged = df_result
+                        st.session_state.merge_result_stale = False
                         
-                        if df_result is not None:
-                            # 保存到session state
-                            st.session_state.df_merged = df_result
-                            
-                            # 显示处理日志
-                            st.success(f"✅ 数据处理完成！共合并 {len(df_result)} 条记录")
-                            
-                            # 显示分配统计
-                            st.subheader("销售顾问分配统计")
-                            allocation_counts = {}
-                            for consultant in selected_consultants:
-                                count = len(df_result[df_result['销售顾问'] == consultant])
-                                allocation_counts[consultant] = count
-                                
-                                # 获取单位
-                                unit = get_consultant_unit(consultant)
-                                st.write(f"**{consultant}** ({unit}): {count}条")
+                        # 显示处理日志
+                        st.success(f"✅ 数据处理完成！共合并 {len(df_result)} 条记录")
+                        
+                        # 显示分配统计
+                        st.subheader("销售顾问分配统计")
+                        allocation_counts = {}
+                        for consultant in selected_consultants:
+                            count = len(df_result[df_result['销售顾问'] == consultant])
+                            allocation_counts[consultant] = count
                             
-                            # 检查分配均匀度
-                            counts = list(allocation_counts.values())
-                            if counts:
-                                max_count = max(counts)
-                                min_count = min(counts)
-                                if max_count - min_count > 1:
-                                    st.warning(f"⚠️ 分配不均匀，最大差值 {max_count - min_count}")
-                                else:
-                                    st.success(f"✓ 分配均匀，最大差值 {max_count - min_count}")
-                    else:
-                        st.error("没有可处理的数据文件")
+                            # 获取单位
+                            unit = get_consultant_unit(consultant)
+                            st.write(f"**{consultant}** ({unit}): {count}条")
+                        
+                        # 检查分配均匀度
+                        counts = list(allocation_counts.values())
+                        if counts:
+                            max_count = max(counts)
+                            min_count = min(counts)
+                            if max_count - min_count > 1:
+                                st.warning(f"⚠️ 分配不均匀，最大差值 {max_count - min_count}")
+                            else:
+                                st.success(f"✓ 分配均匀，最大差值 {max_count - min_count}")
                         
                 except Exception as e:
                     st.error(f"处理失败: {str(e)}")
@@ -959,12 +2623,24 @@ with tab2:
                     st.code(str(e))
     else:
         st.info("请先上传需要处理的文件，并确保已选择至少一个销售顾问")
+    
+    # 处理日志：编码检测、映射前后的值数、导出耗时等
+    with st.expander(f"📝 处理日志（最近 {PROCESSING_LOG_DISPLAY_ENTRIES} 条）", expanded=False):
+        processing_log = st.session_state.processing_log
+        if st.button("🧹 清空处理日志", key="clear_processing_log"):
+            processing_log.clear()
+        if processing_log:
+            st.code("\n".join(processing_log[-PROCESSING_LOG_DISPLAY_ENTRIES:]), language=None)
+        else:
+            st.caption("暂无日志")
 
 with tab3:
     st.header("结果分析与下载")
     
     if st.session_state.df_merged is not None:
         df = st.session_state.df_merged
+        if st.session_state.merge_result_stale:
+            st.warning("⚠️ 映射规则的修改改变了被排除的来源，当前结果仍按修改前的规则生成，请重新合并处理")
         
         # 显示数据预览
         st.subheader("📋 数据预览")
@@ -978,11 +2654,11 @@ with tab3:
             st.metric("总记录数", len(df))
             
             # 车系统计
-            car_stats = df['意向车系'].value_counts()
+            car_stats = category_counts(df['意向车系'])
             st.metric("车型种类", len(car_stats))
             
             # 来源统计
-            source_stats = df['线索来源'].value_counts()
+            source_stats = category_counts(df['线索来源'])
             st.metric("来源渠道", len(source_stats))
             
             # 显示车系统计详情
@@ -993,7 +2669,7 @@ with tab3:
         with col2:
             st.subheader("🔍 车系统计图表")
             if not df['意向车系'].empty:
-                car_stats = df['意向车系'].value_counts()
+                car_stats = category_counts(df['意向车系'])
                 st.bar_chart(car_stats)
             
             # 显示前5大车型
@@ -1009,7 +2685,7 @@ with tab3:
         
         with col3:
             if not df['线索来源'].empty:
-                source_stats = df['线索来源'].value_counts()
+                source_stats = category_counts(df['线索来源'])
                 st.bar_chart(source_stats)
         
         with col4:
@@ -1019,7 +2695,8 @@ with tab3:
         
         # 显示销售顾问统计
         st.subheader("👥 销售顾问统计")
-        consultant_stats = df['销售顾问'].value_counts()
+        consultant_stats = category_counts(df['销售顾问'])
+        consultant_units = df.groupby('销售顾问', observed=True, sort=False)['单位'].first()
         col5, col6 = st.columns(2)
         
         with col5:
@@ -1028,34 +2705,45 @@ with tab3:
         with col6:
             with st.expander("查看销售顾问统计详情"):
                 for consultant, count in consultant_stats.items():
-                    unit = df[df['销售顾问'] == consultant]['单位'].iloc[0] if len(df[df['销售顾问'] == consultant]) > 0 else ""
+                    unit = consultant_units.get(consultant, "")
                     st.write(f"{consultant} ({unit}): {count}条")
         
         # 提供下载
         st.subheader("💾 下载结果")
         
-        # 转换为Excel
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='合并结果')
-        output.seek(0)
+        # 导出文件只在点击生成时构建，按合并结果指纹缓存，重复下载和页面刷新不再重新生成
+        fingerprint = merged_fingerprint(df)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        export_download_button(df, fingerprint, 'xlsx', "📥 下载Excel文件", timestamp, button_type="primary")
+        export_download_button(df, fingerprint, 'csv', "📄 下载CSV文件", timestamp)
         
-        st.download_button(
-            label="📥 下载Excel文件",
-            data=output,
-            file_name=f"CRS线索_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary"
-        )
+        # 按销售顾问拆分：每位顾问一个文件，打包成 ZIP 下载
+        split_format = st.radio("按销售顾问拆分下载", ["Excel", "CSV"], horizontal=True, key="split_export_format")
+        split_kind = 'split_xlsx' if split_format == "Excel" else 'split_csv'
+        export_download_button(df, fingerprint, split_kind, "🗂️ 下载按顾问拆分的压缩包", timestamp)
         
-        # 提供CSV格式下载
-        csv_output = df.to_csv(index=False, encoding='utf-8-sig')
-        st.download_button(
-            label="📄 下载CSV文件",
-            data=csv_output,
-            file_name=f"CRS线索_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv"
-        )
+        # 分配台账：确认本次分配后累加，之后的合并据此平衡余数
+        st.subheader("📒 分配台账")
+        run = allocation_run(df)
+        if run['recorded']:
+            st.caption("本次分配已记入台账")
+        elif st.button("📒 记入分配台账", help="确认本次分配结果：累加各顾问的累计分配数，并把手机号记入历史库"):
+            if record_allocation(df, run['key'], st.session_state.pending_watermarks):
+                st.success("已记入分配台账")
+            else:
+                st.caption("本次分配已记入台账")
+            run['recorded'] = True
+        with st.expander("查看累计分配数"):
+            ledger = read_allocation_ledger([c["姓名"] for c in st.session_state.consultant_settings])
+            st.dataframe(pd.DataFrame(list(ledger.items()), columns=['销售顾问', '累计分配']), use_container_width=True)
+            with closing(open_leads_db()) as conn:
+                bloom_meta = read_bloom_meta(conn)
+            if bloom_meta is not None:
+                st.caption(
+                    f"历史号码布隆过滤器：已存 {bloom_meta['items']} / 容量 {bloom_meta['capacity']} 个号码，"
+                    f"{bloom_meta['bits'] // 8 / 1024 / 1024:.1f} MB，设定误判率 {bloom_meta['fpr']:.2%}，"
+                    f"当前估计 {bloom_estimated_fpr(bloom_meta):.3%}"
+                )
     else:
         st.info("请先处理数据以查看结果")
 
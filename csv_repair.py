@@ -0,0 +1,108 @@
+"""CSV 格式修复：逐块解码、整块修复
+
+独立成模块，供进程池工作进程按模块名导入；这里只有 codecs/字符串操作，不依赖 Streamlit、日志和数据库。
+"""
+import codecs
+import re
+
+REPAIR_BLOCK_BYTES = 1024 * 1024
+LINE_BREAKS = '\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029'   # 与 str.splitlines 的分行字符一致
+ESCAPED_QUOTE = '""'   # 兼容旧版修复逻辑：'""' 视为转义引号，输出为一个引号
+
+def repair_csv_line(line):
+    """修复单行：去掉整行外层引号，按引号外的逗号分字段并去掉字段引号，空的末字段丢弃
+
+    与逐字符扫描的旧实现结果一致，但只使用整串操作；'""' 直接在切分时还原为引号，不再借助占位字符串。
+    """
+    if line.startswith('"') and line.endswith('"'):
+        line = line[1:-1]
+    if '"' not in line:
+        text = line
+        tail_start = line.rfind(',') + 1
+    else:
+        # 先按转义引号切开，各部分之间补回一个引号（不改变引号内外状态）；
+        # 部分内再按引号切分，累计引号数为偶数的段在引号外，去掉引号即为各字段按逗号拼接的结果
+        pieces = []
+        tail_start = 0
+        offset = 0
+        quotes = 0
+        for k, part in enumerate(line.split(ESCAPED_QUOTE)):
+            if k:
+                pieces.append('"')
+                offset += 1
+            for j, segment in enumerate(part.split('"')):
+                quotes += j > 0
+                if quotes % 2 == 0:
+                    comma = segment.rfind(',')
+                    if comma != -1:
+                        tail_start = offset + comma + 1
+                pieces.append(segment)
+                offset += len(segment)
+        text = ''.join(pieces)
+    # 最后一个引号外逗号之后为空时，该空字段被丢弃
+    if tail_start == len(text):
+        text = text[:tail_start - 1] if tail_start else ''
+    return text
+
+# 整块修复：引号与逗号的处理都用整块的字符串操作和一次正则替换完成，不再逐字段执行 Python 代码。
+# 引号外最后一个逗号之后只有引号（即末字段为空）时删去该逗号；正则作用于反转后的文本，
+# 从行尾开始匹配，逗号之前（反转后在其后）的引号数为偶数即在引号外，全程不回溯
+TRAILING_EMPTY_FIELD_REVERSED = re.compile(r'\n"*,(?=(?:[^"\n]*+"[^"\n]*+")*+[^"\n]*+\n)')
+ESCAPED_QUOTE_MARK = '\x00'
+
+def repair_csv_block(lines):
+    """修复一组数据行（已去空白、非空），返回以换行连接的修复结果，与逐行 repair_csv_line 完全一致"""
+    text = '\n'.join(lines)
+    if ESCAPED_QUOTE_MARK in text:
+        # 数据里本身含有标记字符时退回逐行修复
+        return '\n'.join(repair_csv_line(line) for line in lines)
+    if (text[0] == '"' == text[-1] and len(lines[0]) > 1 and len(lines[-1]) > 1
+            and text.count('"\n"') == len(lines) - 1):
+        # 每行都有外层引号（最常见的整行加引号格式），行间的 '"\n"' 一次替换即可全部去掉；
+        # 单个引号的行会让相邻的 '"\n"' 重叠、计数不足，从而走下面的逐行分支
+        text = text[1:-1].replace('"\n"', '\n')
+    elif '"' in text:
+        text = '\n'.join(line[1:-1] if line[0] == '"' == line[-1] else line for line in lines)
+    escaped = ESCAPED_QUOTE in text
+    if escaped:
+        text = text.replace(ESCAPED_QUOTE, ESCAPED_QUOTE_MARK)
+    # 首尾各补一个换行，使每行都夹在两个换行之间
+    text = TRAILING_EMPTY_FIELD_REVERSED.sub('\n', '\n' + text[::-1] + '\n')[-2:0:-1]
+    text = text.replace('"', '')
+    return text.replace(ESCAPED_QUOTE_MARK, '"') if escaped else text
+
+def iter_decoded_blocks(data, encoding, errors='strict'):
+    """按块增量解码并分行，每块产出一组完整的行；分行规则与 str.splitlines 相同"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    carry = ''
+    for start in range(0, len(data), REPAIR_BLOCK_BYTES):
+        block = data[start:start + REPAIR_BLOCK_BYTES]
+        text = carry + decoder.decode(block, final=start + REPAIR_BLOCK_BYTES >= len(data))
+        pieces = text.splitlines()
+        carry = ''
+        if pieces and text[-1] not in LINE_BREAKS:
+            carry = pieces.pop()
+        if pieces:
+            yield pieces
+    if carry:
+        yield [carry]
+
+def iter_repaired_csv(data, encoding, errors='strict', header=True):
+    """逐块产出修复后的CSV文本（行间以换行分隔，末尾不加换行）
+
+    header=False 用于并行修复中除第一段以外的分段：所有行都按数据行处理。
+    """
+    first = header
+    for pieces in iter_decoded_blocks(data, encoding, errors):
+        lines = [line.strip() for line in pieces]
+        if first:
+            # 标题行
+            first = False
+            yield lines.pop(0)
+        lines = [line for line in lines if line]  # 跳过空行
+        if lines:
+            yield '\n' + repair_csv_block(lines)
+
+def repair_csv_chunk(chunk, encoding, errors, header):
+    """修复一段以完整行结束的CSV字节（进程池任务）"""
+    return ''.join(iter_repaired_csv(chunk, encoding, errors, header))
\ No newline at end of file